@@ -32,9 +32,11 @@ long_description='\n'.join((
         read('src', 'lovely', 'testlayers', 'cass.txt'),
         read('src', 'lovely', 'testlayers', 'mysql.txt'),
         read('src', 'lovely', 'testlayers', 'pgsql.txt'),
+        read('src', 'lovely', 'testlayers', 'pgsql_instrument.txt'),
         read('src', 'lovely', 'testlayers', 'mongodb_single.txt'),
         read('src', 'lovely', 'testlayers', 'mongodb_masterslave.txt'),
         read('src', 'lovely', 'testlayers', 'mongodb_replicaset.txt'),
+        read('src', 'lovely', 'testlayers', 'mongodb_sharding.txt'),
         read('src', 'lovely', 'testlayers', 'apacheds.txt'),
         read('src', 'lovely', 'testlayers', 'openldap.txt'),
         read('CHANGES.txt'),
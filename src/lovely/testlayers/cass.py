@@ -17,12 +17,17 @@
 ##############################################################################
 
 from layer import WorkDirectoryLayer
+from lovely.testlayers import util
+import errno
+import glob
+import hashlib
 import logging
 import os
+import re
 import setuptools
 import shutil
+import signal
 import sys
-import telnetlib
 import time
 
 def system(c, log='/dev/null'):
@@ -32,6 +37,10 @@ def system(c, log='/dev/null'):
 
 logger = logging.getLogger(__name__)
 
+# messages logged by cassandra when it accepts client connections
+READY_PATTERN = (r'Cassandra starting up|Listening for thrift clients|'
+                 r'Starting listening for CQL clients')
+
 URL = 'http://archive.apache.org/dist/cassandra/0.4.0/apache-cassandra-incubating-0.4.0-bin.tar.gz'
 
 TMPL_LOG4J = """
@@ -87,14 +96,30 @@ exec $JAVA $JVM_OPTS -Dcassandra -Dstorage-config=$CASSANDRA_CONF \
 class CassandraLayer(WorkDirectoryLayer):
 
     __bases__ = ()
+    setup = None
+    snapshotIdent = None
+    # seconds to wait for cassandra to start and to stop
+    start_timeout = 120
+    stop_timeout = 30
+    # seconds to wait for the exit after SIGKILL
+    kill_timeout = 10
 
     def __init__(self, name, storage_conf, storage_port=17000,
-                 control_port=17001, thrift_port=19160):
+                 control_port=17001, thrift_port=19160, archive=None,
+                 setup=None, snapshotIdent=None, ready_pattern=READY_PATTERN):
+        if setup is not None:
+            self.setup = setup
+            if snapshotIdent is None:
+                self.snapshotIdent = util.dotted_name(setup)
+            else:
+                self.snapshotIdent = snapshotIdent
+        self.ready_pattern = ready_pattern and re.compile(ready_pattern)
         self.storage_port = storage_port
         self.control_port = control_port
         self.thrift_port = thrift_port
         assert os.path.isfile(storage_conf), 'storage_conf invalid path'
         self.storage_conf = storage_conf
+        self.archive = archive
         self.__name__ = name
         self.setUpWD()
         for name in ('var', 'run', 'bin', 'conf', 'log'):
@@ -137,74 +162,176 @@ class CassandraLayer(WorkDirectoryLayer):
         f.close()
         print >> sys.stderr, self.ctl
 
+    def _archive_path(self):
+        """returns the path of the cassandra archive
+
+        The archive is given as path or as directory containing the
+        archive, without an archive ``URL`` gets downloaded into the
+        machine wide cache.
+        """
+        if self.archive is None:
+            import zc.buildout.download
+            dc = os.path.join(util.CACHE, 'downloads')
+            if not os.path.exists(dc):
+                os.makedirs(dc)
+            download = zc.buildout.download.Download(
+                {'directory': util.CACHE, 'download-cache': dc},
+                logger=logger)
+            print >> sys.stderr, "Downloading %s" % URL
+            fname, is_temp = download(URL)
+            return fname
+        if not os.path.isdir(self.archive):
+            return self.archive
+        named = os.path.join(self.archive, os.path.basename(URL))
+        if os.path.isfile(named):
+            return named
+        candidates = sorted(glob.glob(os.path.join(self.archive, '*.tar.gz')))
+        if not candidates:
+            raise ValueError("No cassandra archive found in %r" % self.archive)
+        return candidates[-1]
+
     def _install_cassandra_home(self):
+        """links cassandra_home to the distribution extracted into the
+        machine wide cache, keyed by the SHA-256 of the archive"""
         self.cassandra_home = self.wdPath('cassandra_home')
-        if os.path.exists(self.cassandra_home):
-            return
-        bo = self.wdPath('bo')
-        if not os.path.exists(bo):
-            os.mkdir(bo)
-        dc = os.path.join(bo, 'download-cache')
-        if not os.path.exists(dc):
-            os.mkdir(dc)
-        buildout = {'directory': bo,
-                    'download-cache':'download-cache',
-                    }
-        import zc.buildout.download
-        download = zc.buildout.download.Download(
-            buildout,
-            logger=logger)
-        print >> sys.stderr, "Downloading %s" % URL
-        fname, is_temp = download(URL)
-        dest = self.wdPath('extract')
-        print >> sys.stderr, "Extracting %s" % fname
-        setuptools.archive_util.unpack_archive(fname, dest)
-        root = os.path.join(dest, os.listdir(dest)[0])
-        os.rename(root, self.cassandra_home)
-        shutil.rmtree(dest)
+        archive = self._archive_path()
+        def extract(tree):
+            dest = os.path.join(os.path.dirname(tree), 'extract')
+            print >> sys.stderr, "Extracting %s" % archive
+            setuptools.archive_util.unpack_archive(archive, dest)
+            root = os.path.join(dest, os.listdir(dest)[0])
+            os.rename(root, tree)
+        self.archive_hash = util.file_hash(archive)
+        cached = util.cache_tree('cassandra', self.archive_hash, extract)
+        if os.path.islink(self.cassandra_home):
+            if os.readlink(self.cassandra_home) == cached:
+                return
+            os.unlink(self.cassandra_home)
+        elif os.path.exists(self.cassandra_home):
+            # extracted into the work directory by an older version
+            shutil.rmtree(self.cassandra_home)
+        os.symlink(cached, self.cassandra_home)
+
+    def _pid(self):
+        if not os.path.exists(self.pid_file):
+            return None
+        f = open(self.pid_file)
+        try:
+            return int(f.read().strip())
+        except ValueError:
+            return None
+        finally:
+            f.close()
+
+    def _alive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno == errno.EPERM
+        return True
 
     def _stop(self):
-        if os.path.exists(self.pid_file):
+        """stops cassandra by SIGTERM, it gets killed if it does not
+        exit within stop_timeout seconds"""
+        pid = self._pid()
+        if pid is not None:
             print >> sys.stderr, "%r stopping cassandra" % self.__name__
-            try:
-                system('kill -TERM `cat %s`' % self.pid_file)
-            except SystemError:
-                pass
+            if self._alive(pid):
+                os.kill(pid, signal.SIGTERM)
+            if not self._waitExit(pid, self.stop_timeout):
+                print >> sys.stderr, "%r killing cassandra" % self.__name__
+                os.kill(pid, signal.SIGKILL)
+                if not self._waitExit(pid, self.kill_timeout):
+                    raise SystemError("Cassandra did not exit after SIGKILL",
+                                      pid)
             os.unlink(self.pid_file)
-            # wait until we are down
-            while True:
-                time.sleep(0.2)
-                try:
-                    tn =  telnetlib.Telnet('localhost', self.thrift_port)
-                    tn.close()
-                    print >> sys.stderr, '.',
-                except Exception, e:
-                    break
+        # wait until the port is released
+        deadline = time.time() + self.stop_timeout
+        while util.isUp('localhost', self.thrift_port):
+            if time.time() > deadline:
+                raise SystemError("Port still listening", self.thrift_port)
+            time.sleep(0.05)
+
+    def _waitExit(self, pid, timeout):
+        deadline = time.time() + timeout
+        while self._alive(pid):
+            if time.time() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _snapshotPath(self):
+        """the data directory depends on the cassandra distribution and
+        the storage configuration as well"""
+        f = open(self.storage_conf)
+        conf = f.read()
+        f.close()
+        key = hashlib.sha1(repr((self.archive_hash, conf))).hexdigest()
+        return os.path.join(self._bd, 'var_%s_%s' % (self.snapshotIdent,
+                                                     key))
 
     def _cleanup(self):
         for p in (self.var, self.log):
             shutil.rmtree(p)
             os.mkdir(p)
+        if self.setup is not None and os.path.isdir(self._snapshotPath()):
+            os.rmdir(self.var)
+            util.copytree(self._snapshotPath(), self.var)
+
+    def _makeSnapshot(self):
+        """copies the data directory of the stopped server into the
+        snapshot which gets restored on start"""
+        tmp = '%s.%s.tmp' % (self._snapshotPath(), os.getpid())
+        util.copytree(self.var, tmp)
+        try:
+            os.rename(tmp, self._snapshotPath())
+        except OSError:
+            # made by another process in the meantime
+            shutil.rmtree(tmp)
+            if not os.path.isdir(self._snapshotPath()):
+                raise
+
+    def _ready(self):
+        if not util.isUp('localhost', self.thrift_port):
+            return False
+        if self.ready_pattern is None:
+            return True
+        log = os.path.join(self.log, 'system.log')
+        if not os.path.exists(log):
+            return False
+        f = open(log)
+        try:
+            return self.ready_pattern.search(f.read()) is not None
+        finally:
+            f.close()
 
     def _start(self):
         assert not os.path.exists(self.pid_file), 'PID must not exist'
-        # remove any data
+        # remove any data or restore the snapshot
         self._cleanup()
         print >> sys.stderr, "starting cassandra %r" % self.ctl
         system('sh %s' % self.ctl)
-        while True:
-            try:
-                tn =  telnetlib.Telnet('localhost', self.thrift_port)
-                tn.close()
-                break
-            except Exception, e:
-                print >> sys.stderr, '.',
-                time.sleep(0.2)
+        deadline = time.time() + self.start_timeout
+        while not self._ready():
+            pid = self._pid()
+            if pid is not None and not self._alive(pid):
+                os.unlink(self.pid_file)
+                raise SystemError("Cassandra exited, see %r" % self.log)
+            if time.time() > deadline:
+                raise SystemError("Cassandra did not start within %s secs" %
+                                  self.start_timeout)
+            time.sleep(0.05)
 
     def setUp(self):
         self._stop()
         self._start()
+        if self.setup is not None and not os.path.isdir(
+            self._snapshotPath()):
+            # create the schema once, later starts restore it
+            self.setup(self)
+            self._stop()
+            self._makeSnapshot()
+            self._start()
 
     def tearDown(self):
         self._stop()
-
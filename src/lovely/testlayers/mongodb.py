@@ -27,11 +27,24 @@ Various flavors of test layers for MongoDB:
 - The ``MongoReplicaSetLayer`` starts and stops multiple MongoDB
   instances and configures a replica set between them.
 - The ``MongoShardingLayer`` starts and stops multiple MongoDB instances as
-  well as a ``mongos`` instance and configures sharding between them. [TODO]
+  well as a ``mongos`` instance and configures sharding between them.
 """
 import os
+import re
 import time
+import json
+import Queue
+import struct
+import shutil
+import tarfile
+import hashlib
 import logging
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from lovely.testlayers import util
+from lovely.testlayers import layer
 from lovely.testlayers.util import asbool, DuplicateSuppressingLogFilter
 from lovely.testlayers.layer import WorkspaceLayer, CascadedLayer
 from lovely.testlayers.server import ServerLayer
@@ -47,16 +60,507 @@ logger.addFilter(DuplicateSuppressingLogFilter())
 logger.setLevel(logging.INFO)
 
 
-class MongoLayer(WorkspaceLayer, ServerLayer):
+def mongod_options(version, density = False, replica = False,
+        enterprise = False, memory = None):
+    """
+    Computes the ``mongod`` options matching its version.
+
+    The legacy MMAPv1 options and the REST interface are only used by the
+    versions supporting them::
+
+        >>> from pprint import pprint
+        >>> pprint(mongod_options((2, 4, 4)))
+        {'noprealloc': True, 'rest': True, 'smallfiles': True}
+        >>> pprint(mongod_options((4, 0, 3)))
+        {}
+
+    The density profile lowers the footprint of a node, ``density`` is the
+    number of nodes sharing the memory of the host. The WiredTiger cache
+    is capped, the journal is disabled for standalone servers and the
+    oplog of replica set members is kept small::
+
+        >>> pprint(mongod_options((4, 0, 3), density = 4,
+        ...     memory = 8 * 1024**3))
+        {'nojournal': True, 'wiredTigerCacheSizeGB': 0.25}
+        >>> pprint(mongod_options((4, 0, 3), density = 4, replica = True,
+        ...     memory = 32 * 1024**3))
+        {'journalCommitInterval': 500,
+         'oplogSize': 64,
+         'wiredTigerCacheSizeGB': 1.0}
+
+    Enterprise builds keep the data in memory::
+
+        >>> pprint(mongod_options((4, 0, 3), density = 4, replica = True,
+        ...     enterprise = True, memory = 8 * 1024**3))
+        {'inMemorySizeGB': 0.25, 'oplogSize': 64, 'storageEngine': 'inMemory'}
+    """
+    options = {}
+    if version < (3, 6):
+        options['rest'] = True
+    if version < (3, 2):
+        # MMAPv1 is the default storage engine
+        options['noprealloc'] = True
+        options['smallfiles'] = True
+    if not density:
+        return options
+    if replica:
+        options['oplogSize'] = 64
+    if version < (3, 2):
+        return options
+    memory = memory or util.physical_memory() or 1024**3
+    # an eighth of the memory shared by all nodes
+    size = memory / 8.0 / int(density) / 1024**3
+    if version >= (3, 4):
+        size = min(max(round(size, 2), 0.25), 1.0)
+    else:
+        # fractional sizes are supported since 3.4
+        size = 1
+    if enterprise:
+        options['storageEngine'] = 'inMemory'
+        options['inMemorySizeGB'] = size
+        return options
+    options['wiredTigerCacheSizeGB'] = size
+    if not replica and version < (6, 1):
+        options['nojournal'] = True
+    elif version < (7, 0):
+        options['journalCommitInterval'] = 500
+    return options
+
+
+# collection holding the content hashes of the loaded fixtures
+FIXTURE_MARKERS = 'ltl_fixtures'
+
+
+def iter_documents(path):
+    """
+    Yields the documents of a fixture file. Files ending with ``.bson``
+    contain BSON documents as written by ``mongodump``, other files
+    contain one JSON or MongoDB extended JSON document per line.
+    """
+    from bson import BSON
+    from bson.json_util import object_hook
+    if path.endswith('.bson'):
+        f = open(path, 'rb')
+        try:
+            while True:
+                header = f.read(4)
+                if not header:
+                    break
+                size = struct.unpack('<i', header)[0]
+                yield BSON(header + f.read(size - 4)).decode()
+        finally:
+            f.close()
+        return
+    f = open(path)
+    try:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line, object_hook=object_hook)
+    finally:
+        f.close()
+
+
+def load_fixture(address, db_name, collection, path, indexes = (),
+        batch_size = 1000, workers = 4):
+    """
+    Loads the documents of a fixture file into a collection, see
+    ``iter_documents`` for the file formats.
+
+    The documents are inserted in batches of ``batch_size`` by unordered
+    bulk inserts over ``workers`` connections. ``indexes`` is a list of
+    ``(key, options)`` tuples, the indexes are built after loading.
+
+    The content hash of the file is stored in the ``ltl_fixtures``
+    collection of the database, loading is skipped if the collection
+    holds the file already. Returns whether the fixture got loaded.
+    """
+    from pymongo import Connection
+    digest = util.file_hash(path)
+    conn = Connection(address, safe=True)
+    try:
+        db = conn[db_name]
+        marker = db[FIXTURE_MARKERS].find_one({'_id': collection})
+        if marker is not None and marker.get('hash') == digest:
+            return False
+        t = time.time()
+        db.drop_collection(collection)
+        batches = Queue.Queue(workers * 2)
+        errors = []
+        def insert():
+            # a failing worker keeps draining the queue, otherwise the
+            # main thread would block on putting the next batch
+            worker_conn = None
+            try:
+                worker_conn = Connection(address, safe=True)
+                coll = worker_conn[db_name][collection]
+            except Exception, e:
+                errors.append(e)
+            try:
+                while True:
+                    batch = batches.get()
+                    if batch is None:
+                        break
+                    if errors:
+                        continue
+                    try:
+                        coll.insert(batch, continue_on_error=True)
+                    except Exception, e:
+                        errors.append(e)
+            finally:
+                if worker_conn is not None:
+                    worker_conn.disconnect()
+        threads = [threading.Thread(target=insert) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        count = 0
+        try:
+            batch = []
+            for document in iter_documents(path):
+                if errors:
+                    break
+                batch.append(document)
+                if len(batch) >= batch_size:
+                    batches.put(batch)
+                    count += len(batch)
+                    batch = []
+            if batch and not errors:
+                batches.put(batch)
+                count += len(batch)
+        finally:
+            for thread in threads:
+                batches.put(None)
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        for key, options in indexes:
+            db[collection].create_index(key, **options)
+        db[FIXTURE_MARKERS].save({'_id': collection, 'hash': digest})
+        logger.info('Loaded {0} documents into {1}.{2} in {3:.2f}s'.format(
+            count, db_name, collection, time.time() - t))
+        return True
+    finally:
+        conn.disconnect()
+
+
+class LoadFixture(object):
+    """
+    A setup for the Mongo layers which loads a fixture file into a
+    collection, see ``load_fixture``.
+
+    The name is built from the contents of the file, so the snapshot of
+    the setup changes with the fixture.
+    """
+
+    def __init__(self, db_name, collection, path, indexes = (), **kwargs):
+        self.db_name = db_name
+        self.collection = collection
+        self.path = path
+        self.indexes = indexes
+        self.kwargs = kwargs
+        ident = (db_name, collection, list(indexes), util.file_hash(path))
+        self.__name__ = self.__class__.__name__ + hashlib.sha1(
+            repr(ident)).hexdigest()
+
+    def __call__(self, layer):
+        layer.load_fixture(self.db_name, self.collection, self.path,
+                           self.indexes, **self.kwargs)
+
+
+class MongoResetMixin(object):
+    """
+    Resets databases to their state after the layer setup between tests.
+
+    On the first ``testSetUp`` the documents, indexes and options of all
+    collections of ``reset_databases`` are captured in memory as BSON.
+    On later calls ``dbHash`` and the indexes tell which collections
+    changed, these are dropped and reinserted. Collections created by the
+    test are dropped. Writes are acknowledged by all ``reset_hosts``, so
+    tests reading from secondaries see the restored data.
+    """
+
+    reset_databases = ()
+    reset_batch_size = 1000
+    _reset_data = None
+    _reset_conn = None
+
+    @property
+    def reset_hosts(self):
+        """
+        The addresses used for connecting to the databases.
+        """
+        raise NotImplementedError
+
+    def reset_connection(self):
+        from pymongo import Connection
+        if self._reset_conn is None:
+            self._reset_conn = Connection(','.join(self.reset_hosts),
+                                          safe=True,
+                                          w=len(self.reset_hosts))
+        return self._reset_conn
+
+    def reset_indexes(self, coll):
+        """
+        The keys and options of the secondary indexes of a collection.
+        """
+        indexes = []
+        for index_name, info in sorted(coll.index_information().items()):
+            if index_name == '_id_':
+                continue
+            options = dict([(k, v) for k, v in info.items()
+                            if k not in ('key', 'v', 'ns')])
+            options['name'] = index_name
+            indexes.append((info['key'], options))
+        return indexes
+
+    def reset_capture(self):
+        from bson import BSON
+        from bson.son import SON
+        conn = self.reset_connection()
+        self._reset_data = {}
+        for db_name in self.reset_databases:
+            db = conn[db_name]
+            hashes = db.command('dbHash').get('collections', {})
+            collections = {}
+            for name in hashes:
+                if name.startswith('system.'):
+                    continue
+                coll = db[name]
+                collections[name] = dict(
+                    hash=hashes[name],
+                    options=coll.options(),
+                    indexes=self.reset_indexes(coll),
+                    documents=[BSON.encode(doc)
+                               for doc in coll.find(as_class=SON)])
+            self._reset_data[db_name] = collections
+
+    def reset_restore(self):
+        """
+        Restores the modified collections, returns their names.
+        """
+        from bson import BSON
+        from bson.son import SON
+        conn = self.reset_connection()
+        restored = []
+        for db_name, collections in self._reset_data.items():
+            db = conn[db_name]
+            hashes = db.command('dbHash').get('collections', {})
+            names = set(collections) | set([name for name in hashes
+                                            if not name.startswith('system.')])
+            for name in sorted(names):
+                data = collections.get(name)
+                # dbHash only covers the documents
+                if (data is not None and hashes.get(name) == data['hash']
+                    and self.reset_indexes(db[name]) == data['indexes']):
+                    continue
+                db.drop_collection(name)
+                restored.append('%s.%s' % (db_name, name))
+                if data is None:
+                    continue
+                if data['options']:
+                    db.create_collection(name, **data['options'])
+                coll = db[name]
+                documents = data['documents']
+                for i in range(0, len(documents), self.reset_batch_size):
+                    coll.insert([BSON(doc).decode(as_class=SON) for doc in
+                                 documents[i:i + self.reset_batch_size]])
+                for key, options in data['indexes']:
+                    coll.create_index(key, **options)
+        return restored
+
+    def reset_release(self):
+        self._reset_data = None
+        if self._reset_conn is not None:
+            self._reset_conn.disconnect()
+            self._reset_conn = None
+
+    def testSetUp(self):
+        if not self.reset_databases:
+            return
+        if self._reset_data is None:
+            self.reset_capture()
+        else:
+            self.reset_restore()
+
+
+class MongoSnapshotMixin(object):
+    """
+    Snapshots of all databases as gzipped ``mongodump`` archives.
+
+    Archives are supported by the tools since MongoDB 3.2, older tools
+    dump into a directory which is kept as gzipped tarball.
+
+    If a ``setup`` callable is given it gets called with the layer once
+    the server is up, afterwards a snapshot is made. Later setups restore
+    this snapshot in parallel instead of calling ``setup`` again. The
+    snapshot is identified by ``snapshotIdent`` which defaults to the
+    dotted name of ``setup``, so setup callables should encode their
+    inputs in their name.
+    """
+
+    setup = None
+    snapshotIdent = None
+    snapDir = None
+    restore_workers = None
+
+    def snapshot_init(self, setup, snapshotIdent):
+        if setup is not None:
+            self.setup = setup
+            if snapshotIdent is None:
+                self.snapshotIdent = util.dotted_name(setup)
+            else:
+                self.snapshotIdent = snapshotIdent
+
+    @property
+    def snapshot_host(self):
+        """
+        The address passed to ``mongodump`` and ``mongorestore``.
+        """
+        raise NotImplementedError
+
+    @property
+    def snapshot_dir(self):
+        raise NotImplementedError
+
+    @property
+    def snapshot_version(self):
+        """
+        The version of the MongoDB tools, which ship with ``mongod``.
+        """
+        return self.mongod_version
+
+    @property
+    def snapshot_archives(self):
+        return self.snapshot_version >= (3, 2)
+
+    def mongo_tool(self, name):
+        """
+        The path of a MongoDB tool next to ``mongod``.
+        """
+        mongod_bin = self.mongod_bin or 'mongod'
+        return os.path.join(os.path.dirname(mongod_bin), name)
+
+    def _snapPath(self, ident):
+        if self.snapshot_archives:
+            name = 'ss_%s.archive.gz' % ident
+        else:
+            name = 'ss_%s.tar.gz' % ident
+        return os.path.join(self.snapshot_dir, name)
+
+    def snapshotInfo(self, ident="1"):
+        sp = self._snapPath(ident)
+        return os.path.isfile(sp), sp
+
+    def makeSnapshot(self, ident="1"):
+        assert ident
+        exists, sp = self.snapshotInfo(ident)
+        if not os.path.isdir(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir)
+        # dump to a temporary file, so no partial snapshots are left
+        tmp = '%s.%s.tmp' % (sp, os.getpid())
+        cmd = [self.mongo_tool('mongodump'), '--host', self.snapshot_host]
+        t = time.time()
+        try:
+            if self.snapshot_archives:
+                subprocess.check_call(cmd + ['--archive=%s' % tmp, '--gzip',
+                                             '--quiet'])
+            else:
+                self._dump_tarball(cmd, tmp)
+            os.rename(tmp, sp)
+        finally:
+            os.path.exists(tmp) and os.unlink(tmp)
+        logger.info('Dumped snapshot {0} in {1:.2f}s'.format(
+            sp, time.time() - t))
+
+    def restoreSnapshot(self, ident="1"):
+        assert ident
+        exists, sp = self.snapshotInfo(ident)
+        if not exists:
+            raise ValueError("Snapshot %r not found" % ident)
+        cmd = [self.mongo_tool('mongorestore'), '--host', self.snapshot_host,
+               '--drop']
+        t = time.time()
+        if self.snapshot_archives:
+            workers = self.restore_workers or multiprocessing.cpu_count()
+            subprocess.check_call(cmd + ['--archive=%s' % sp, '--gzip',
+                '--quiet', '--numParallelCollections=%s' % workers])
+        else:
+            self._restore_tarball(cmd, sp)
+        logger.info('Restored snapshot {0} in {1:.2f}s'.format(
+            sp, time.time() - t))
+
+    def _dump_tarball(self, cmd, path):
+        """
+        Dump with ``mongodump --out`` and pack the directory into ``path``.
+        """
+        tmp = tempfile.mkdtemp()
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(cmd + ['--out', tmp], stdout = devnull)
+            tar = tarfile.open(path, 'w:gz')
+            tar.add(tmp, arcname = 'dump')
+            tar.close()
+        finally:
+            shutil.rmtree(tmp)
+
+    def _restore_tarball(self, cmd, path):
+        """
+        Unpack ``path`` and restore the directory with ``mongorestore``.
+        """
+        tmp = tempfile.mkdtemp()
+        try:
+            tar = tarfile.open(path, 'r:gz')
+            tar.extractall(tmp)
+            tar.close()
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(cmd + [os.path.join(tmp, 'dump')],
+                                      stdout = devnull)
+        finally:
+            shutil.rmtree(tmp)
+
+    def load_fixture(self, db_name, collection, path, indexes = (),
+            **kwargs):
+        """
+        Loads a fixture file into a collection, see ``load_fixture``.
+        """
+        return load_fixture(','.join(self.reset_hosts), db_name,
+                            collection, path, indexes, **kwargs)
+
+    def snapshot_setup(self):
+        """
+        Call ``setup`` and snapshot its result or restore the snapshot
+        if it exists already.
+        """
+        if self.setup is None:
+            return
+        exists, sp = self.snapshotInfo(self.snapshotIdent)
+        if exists:
+            self.restoreSnapshot(self.snapshotIdent)
+        else:
+            self.setup(self)
+            self.makeSnapshot(self.snapshotIdent)
+
+
+class MongoLayer(MongoResetMixin, MongoSnapshotMixin, WorkspaceLayer,
+                 ServerLayer):
     """
     Encapsulates controlling a single MongoDB instance.
     """
 
     __bases__ = ()
 
+    # data directory copied into an empty ``var`` directory on start
+    seed_path = None
+
+    # seconds to wait for ``mongod`` to shut down before killing it
+    stop_timeout = 30
+
     def __init__(self, name, mongod_bin = None,
                     hostname = 'localhost', storage_port = 37017,
-                    cleanup = True, extra_options = None):
+                    cleanup = True, extra_options = None,
+                    reset_databases = None, setup = None,
+                    snapshotIdent = None, density = False):
         """
         Settings for ``MongoLayer``
 
@@ -83,6 +587,23 @@ class MongoLayer(WorkspaceLayer, ServerLayer):
         :extra_options:
             Additional command line options to be passed to ``mongod``,
             defaults to empty dictionary
+
+        :reset_databases:
+            Names of the databases which get reset to their state after
+            the layer setup before each test, see ``MongoResetMixin``
+
+        :setup:
+            Callable which gets called with the layer to load fixtures,
+            the result is cached as snapshot, see ``MongoSnapshotMixin``
+
+        :snapshotIdent:
+            Identifies the snapshot of ``setup``, defaults to its dotted
+            name
+
+        :density:
+            Run ``mongod`` with a low footprint, the number of nodes
+            sharing the host or ``True`` for a single node, see
+            ``mongod_options``. Defaults to ``False``
         """
 
         # Essential attributes
@@ -100,6 +621,9 @@ class MongoLayer(WorkspaceLayer, ServerLayer):
         self.storage_port = storage_port
         self.console_port = storage_port + 1000
         self.extra_options = extra_options or {}
+        self.reset_databases = reset_databases or ()
+        self.snapshot_init(setup, snapshotIdent)
+        self.density = density
 
         logger.info(u'Initializing server layer {__name__} ({__classname__}) on port={storage_port}, workingdir={workingdir}'.format(**self.__dict__))
 
@@ -118,13 +642,28 @@ class MongoLayer(WorkspaceLayer, ServerLayer):
             'dbpath': self.var_path,
             'pidfilepath': self.pid_file,
             'logpath': self.log_file,
-            'rest': True,
-            'noprealloc': True,
-            'smallfiles': True,
         }
+
+    def mongod_arguments(self):
+        """
+        The options ``mongod`` gets started with.
+        """
+        version_options = mongod_options(self.mongod_version,
+            density = self.density,
+            replica = 'replSet' in self.extra_options,
+            enterprise = self.mongod_enterprise)
         all_options = {}
         all_options.update(self.default_options)
+        all_options.update(version_options)
         all_options.update(self.extra_options)
+        return all_options
+
+    def setup_command(self):
+        """
+        Compute the command line and the ports to check for the
+        installed version of ``mongod``.
+        """
+        all_options = self.mongod_arguments()
 
         # compute "self.start_cmd"
         arguments_string = self._serialize_arguments(all_options)
@@ -132,24 +671,73 @@ class MongoLayer(WorkspaceLayer, ServerLayer):
         logger.debug('start_cmd=%s' % self.start_cmd)
 
         # compute "self.servers"
-        self.servers = [
-            (self.hostname, self.storage_port),
-            (self.hostname, self.console_port),
-        ]
+        self.servers = [(self.hostname, self.storage_port)]
+        if all_options.get('rest'):
+            self.servers.append((self.hostname, self.console_port))
+
+    @property
+    def mongod_version_info(self):
+        """
+        The output of ``mongod --version``.
+        """
+        if not hasattr(self, '_mongod_version_info'):
+            self._mongod_version_info = subprocess.Popen(
+                [self.mongod_bin, '--version'],
+                stdout=subprocess.PIPE).communicate()[0]
+        return self._mongod_version_info
+
+    @property
+    def mongod_version(self):
+        """
+        The version of ``mongod`` as tuple of integers.
+        """
+        match = re.search(r'version v?(\d+(\.\d+)*)',
+                          self.mongod_version_info)
+        if match is None:
+            raise RuntimeError('Unable to determine the mongod version')
+        return tuple(map(int, match.group(1).split('.')))
+
+    @property
+    def mongod_enterprise(self):
+        """
+        Whether ``mongod`` is an enterprise build.
+        """
+        return 'enterprise' in self.mongod_version_info
 
     def start(self):
         """
         Propagates start operation to ``ServerLayer``.
         Beforehand, brutally removes pid- and lock-files
         to be graceful if the last shutdown went wrong.
+        An empty data directory is seeded from ``seed_path``.
         """
         os.path.exists(self.pid_file) and os.unlink(self.pid_file)
         os.path.exists(self.lock_file) and os.unlink(self.lock_file)
+        if self.seed_path and os.path.isdir(self.seed_path) and \
+            not os.listdir(self.var_path):
+            logger.info('Seeding {0} from {1}'.format(
+                self.var_path, self.seed_path))
+            os.rmdir(self.var_path)
+            util.copytree(self.seed_path, self.var_path)
+        self.setup_command()
         ServerLayer.start(self)
 
-    def stop_acme(self):
-        # TODO: Maybe use "admin.command('shutdown')" instead of just killing the server process?
-        pass
+    def stop(self):
+        """
+        Shuts ``mongod`` down by SIGTERM, so the data files are left in a
+        clean state. The process gets killed if it does not exit within
+        ``stop_timeout`` seconds.
+        """
+        self.process.terminate()
+        deadline = time.time() + self.stop_timeout
+        while self.process.poll() is None:
+            if time.time() > deadline:
+                logger.warning('Killing mongod on port {0}'.format(
+                    self.storage_port))
+                self.process.kill()
+                self.process.wait()
+                break
+            time.sleep(0.05)
 
     def _serialize_arguments(self, arguments):
         """
@@ -167,10 +755,27 @@ class MongoLayer(WorkspaceLayer, ServerLayer):
             argument_list.append(argument_item)
         return ' '.join(argument_list)
 
+    @property
+    def reset_hosts(self):
+        return ['{0}:{1}'.format(self.hostname, self.storage_port)]
+
+    @property
+    def snapshot_host(self):
+        return '{0}:{1}'.format(self.hostname, self.storage_port)
+
+    @property
+    def snapshot_dir(self):
+        return self.snapDir or self._bd
+
+    def setUp(self):
+        ServerLayer.setUp(self)
+        self.snapshot_setup()
+
     def tearDown(self):
         """
         Tear down the test layer. Remove the working directory.
         """
+        self.reset_release()
         ServerLayer.tearDown(self)
         # TODO:
         # maybe differentiate between cleaning up the working directory
@@ -178,12 +783,208 @@ class MongoLayer(WorkspaceLayer, ServerLayer):
         self.workspace_cleanup()
 
 
+class MongoStatsSampler(object):
+    """
+    Samples ``serverStatus`` of MongoDB nodes in a background thread.
+
+    Each sample records the ``opcounters``, the ``opLatencies`` and the
+    replication lag of every node over one persistent connection per
+    node. ``mark`` takes a sample and starts a new period, ``report``
+    computes the read/write distribution, throughput and latencies of
+    a period. The test runner does not tell layers which test runs, so
+    tests call ``mark`` themselves, e.g. with their name in ``setUp``.
+    """
+
+    def __init__(self, hosts, interval = 0.5):
+        """
+        :hosts: (required)
+            The addresses of the nodes, ``<hostname>:<port>``
+
+        :interval:
+            Seconds between two samples, defaults to ``0.5``
+        """
+        self.hosts = hosts
+        self.interval = interval
+        self.samples = []
+        self.marks = []
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def connection(self, host):
+        from pymongo import Connection
+        if host not in self.connections:
+            self.connections[host] = Connection(host, slave_okay=True)
+        return self.connections[host]
+
+    def sample(self):
+        """
+        Take a sample of all nodes, returns its index.
+        """
+        from pymongo.errors import ConnectionFailure
+        with self.lock:
+            nodes = {}
+            for host in self.hosts:
+                try:
+                    status = self.connection(host).admin.command(
+                        'serverStatus')
+                except ConnectionFailure, e:
+                    logger.warning('Sampling {0} failed: {1}'.format(host, e))
+                    self.connections.pop(host, None)
+                    continue
+                repl = status.get('repl', {})
+                nodes[host] = {
+                    'opcounters': status.get('opcounters', {}),
+                    'opLatencies': status.get('opLatencies', {}),
+                    'primary': bool(repl.get('ismaster')),
+                    'lag': 0,
+                }
+            self.sample_lag(nodes)
+            self.samples.append((time.time(), nodes))
+            return len(self.samples) - 1
+
+    def sample_lag(self, nodes):
+        """
+        Compute the replication lag of the secondaries in seconds.
+        """
+        from pymongo.errors import ConnectionFailure, OperationFailure
+        for host in nodes:
+            try:
+                status = self.connection(host).admin.command(
+                    'replSetGetStatus')
+            except OperationFailure:
+                # not a replica set
+                return
+            except ConnectionFailure:
+                continue
+            members = status.get('members', [])
+            primary = [member.get('optimeDate') for member in members
+                       if member.get('stateStr') == 'PRIMARY']
+            if not primary or primary[0] is None:
+                return
+            for member in members:
+                name, optime = member['name'], member.get('optimeDate')
+                if name in nodes and optime is not None:
+                    lag = (primary[0] - optime).total_seconds()
+                    nodes[name]['lag'] = max(lag, 0)
+            return
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.stopped.clear()
+        self.mark(None)
+        self.thread = threading.Thread(target=self.run,
+                                       name='MongoStatsSampler')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.mark(None)
+        with self.lock:
+            while self.connections:
+                self.connections.popitem()[1].disconnect()
+
+    def mark(self, label):
+        """
+        Start a new period labeled ``label``, e.g. the name of a test.
+        """
+        self.marks.append((label, self.sample()))
+
+    def periods(self, label):
+        """
+        The ranges of sample indexes of the periods labeled ``label``.
+        """
+        for number, (name, start) in enumerate(self.marks):
+            if name != label:
+                continue
+            if number + 1 < len(self.marks):
+                yield start, self.marks[number + 1][1]
+            else:
+                yield start, len(self.samples) - 1
+
+    def report(self, label):
+        """
+        Returns the statistics of each node for the periods labeled
+        ``label``:
+
+        - ``reads``, ``writes`` and ``commands``: the operation counts,
+          reads are queries only, because getmores are dominated by the
+          secondaries tailing the oplog of the primary
+        - ``reads_per_sec`` and ``writes_per_sec``: the throughput
+        - ``read_share`` and ``write_share``: the part of all reads and
+          writes of the cluster handled by the node
+        - ``read_latency`` and ``write_latency``: the mean latency of all
+          read and write operations in milliseconds, as counted by
+          ``opLatencies`` (MongoDB 3.2 and later)
+        - ``max_lag``: the maximum replication lag in seconds
+        - ``primary``: whether the node was ``PRIMARY`` at the end
+        """
+        stats = {}
+        for start, end in self.periods(label):
+            duration = self.samples[end][0] - self.samples[start][0]
+            for host, last in self.samples[end][1].items():
+                first = self.samples[start][1].get(host)
+                if first is None:
+                    continue
+                s = stats.setdefault(host, {
+                    'reads': 0, 'writes': 0, 'commands': 0, 'duration': 0,
+                    'read_micros': 0, 'write_micros': 0, 'read_ops': 0,
+                    'write_ops': 0, 'max_lag': 0})
+                delta = lambda name: (last['opcounters'].get(name, 0) -
+                                      first['opcounters'].get(name, 0))
+                s['reads'] += delta('query')
+                s['writes'] += delta('insert') + delta('update') + \
+                               delta('delete')
+                s['commands'] += delta('command')
+                s['duration'] += duration
+                # the latencies cover all read and write operations,
+                # e.g. getmores and batched inserts count once
+                for kind in ('read', 'write'):
+                    before = first['opLatencies'].get(kind + 's', {})
+                    after = last['opLatencies'].get(kind + 's', {})
+                    s[kind + '_micros'] += after.get('latency', 0) - \
+                                           before.get('latency', 0)
+                    s[kind + '_ops'] += after.get('ops', 0) - \
+                                        before.get('ops', 0)
+                s['max_lag'] = max([s['max_lag']] + [
+                    nodes[host]['lag']
+                    for stamp, nodes in self.samples[start:end + 1]
+                    if host in nodes])
+                s['primary'] = last['primary']
+        total_reads = sum([node['reads'] for node in stats.values()])
+        total_writes = sum([node['writes'] for node in stats.values()])
+        for s in stats.values():
+            duration = s.pop('duration')
+            read_micros = s.pop('read_micros')
+            write_micros = s.pop('write_micros')
+            read_ops = s.pop('read_ops')
+            write_ops = s.pop('write_ops')
+            s['reads_per_sec'] = duration and float(s['reads']) / duration
+            s['writes_per_sec'] = duration and float(s['writes']) / duration
+            s['read_share'] = total_reads and float(s['reads']) / total_reads
+            s['write_share'] = total_writes and \
+                float(s['writes']) / total_writes
+            s['read_latency'] = read_ops and \
+                read_micros / 1000.0 / read_ops
+            s['write_latency'] = write_ops and \
+                write_micros / 1000.0 / write_ops
+        return stats
+
+
 class MongoMultiNodeLayer(CascadedLayer):
 
     def __init__(self, name,
             mongod_bin = None,
             hostname = 'localhost', storage_port_base = None,
-            count = 0, cleanup = True):
+            count = 0, cleanup = True, density = False):
         """
         Base class.
 
@@ -211,6 +1012,11 @@ class MongoMultiNodeLayer(CascadedLayer):
         :cleanup:
             Whether to erase the workspace directory on initialization,
             defaults to ``True``
+
+        :density:
+            Run the nodes with a low footprint, ``True`` shares the memory
+            of the host between ``count`` nodes, a number shares it between
+            as many nodes. Defaults to ``False``
         """
         self.name = name
         self.mongod_bin = mongod_bin
@@ -218,6 +1024,7 @@ class MongoMultiNodeLayer(CascadedLayer):
         self.storage_port_base = storage_port_base
         self.count = count
         self.cleanup = cleanup
+        self.density = density
         self.layers = []
 
         logger.info('Initializing %s with layer_options=%s' %
@@ -236,6 +1043,15 @@ class MongoMultiNodeLayer(CascadedLayer):
             storage_port = self.storage_port_base + i
             yield layer_name, storage_port
 
+    @property
+    def node_density(self):
+        """
+        The ``density`` option of the nodes.
+        """
+        if self.density is True:
+            return self.count
+        return self.density
+
     @property
     def storage_ports(self):
         """
@@ -243,6 +1059,20 @@ class MongoMultiNodeLayer(CascadedLayer):
         """
         return [storage_port for _, storage_port in self.layer_options]
 
+    def start_sampler(self, interval = 0.5):
+        """
+        Start sampling the statistics of all nodes in the background,
+        returns the ``MongoStatsSampler``.
+        """
+        hosts = ['{0}:{1}'.format(self.hostname, port)
+                 for port in self.storage_ports]
+        self.sampler = MongoStatsSampler(hosts, interval = interval)
+        self.sampler.start()
+        return self.sampler
+
+    def stop_sampler(self):
+        self.sampler.stop()
+
     def get_opcounters(self):
         """
         doctest convenience function to retrieve ``opcounters`` from
@@ -290,7 +1120,7 @@ class MongoMasterSlaveLayer(MongoMultiNodeLayer):
     def __init__(self, name,
             mongod_bin = None,
             hostname = 'localhost', storage_port_base = 37020,
-            count = 3, cleanup = True):
+            count = 3, cleanup = True, density = False):
         """
         Make a ``MongoMasterSlaveLayer`` from a ``MongoMultiNodeLayer``
 
@@ -317,12 +1147,15 @@ class MongoMasterSlaveLayer(MongoMultiNodeLayer):
         :cleanup:
             Whether to erase the workspace directory on initialization,
             defaults to ``True``.
+
+        :density:
+            Run the nodes with a low footprint, see ``MongoMultiNodeLayer``
         """
         self.master_port = storage_port_base
         MongoMultiNodeLayer.__init__(self, name,
             mongod_bin = mongod_bin,
             hostname = hostname, storage_port_base = storage_port_base,
-            count = count, cleanup = cleanup)
+            count = count, cleanup = cleanup, density = density)
 
     def create_layers(self):
         """
@@ -344,16 +1177,21 @@ class MongoMasterSlaveLayer(MongoMultiNodeLayer):
                 }
             mongo = MongoLayer(layer_name,
                 mongod_bin = self.mongod_bin, storage_port = storage_port,
-                cleanup = self.cleanup, extra_options = extra_options)
+                cleanup = self.cleanup, extra_options = extra_options,
+                density = self.node_density)
             self.layers.append(mongo)
 
 
-class MongoReplicaSetLayer(MongoMultiNodeLayer):
+class MongoReplicaSetLayer(MongoResetMixin, MongoSnapshotMixin,
+                           MongoMultiNodeLayer):
 
     def __init__(self, name,
             mongod_bin = None,
             hostname = 'localhost', storage_port_base = 37030,
-            count = 3, cleanup = True, replicaset_name = None):
+            count = 3, cleanup = True, replicaset_name = None,
+            election_timeout = None, priorities = None,
+            datadir_cache = False, reset_databases = None, setup = None,
+            snapshotIdent = None, density = False):
         """
         Make a ``MongoReplicaSetLayer`` from a ``MongoMultiNodeLayer``
 
@@ -383,12 +1221,45 @@ class MongoReplicaSetLayer(MongoMultiNodeLayer):
 
         :replicaset_name:
             Which name to use for the replica set. Defaults to the layer name.
+
+        :election_timeout:
+            ``electionTimeoutMillis`` of the replica set, defaults to the
+            setting of ``mongod``
+
+        :priorities:
+            Optional list of member priorities, one for each node
+
+        :datadir_cache:
+            Whether to cache the data directories of the initiated replica
+            set. Empty data directories are restored from the cache, so the
+            nodes boot as configured members and no initiation is needed.
+            Defaults to ``False``
+
+        :reset_databases:
+            Names of the databases which get reset to their state after
+            the layer setup before each test, see ``MongoResetMixin``
+
+        :setup:
+            Callable which gets called with the layer to load fixtures,
+            the result is cached as snapshot, see ``MongoSnapshotMixin``
+
+        :snapshotIdent:
+            Identifies the snapshot of ``setup``, defaults to its dotted
+            name
+
+        :density:
+            Run the nodes with a low footprint, see ``MongoMultiNodeLayer``
         """
         self.replicaset_name = replicaset_name or name
+        self.election_timeout = election_timeout
+        self.priorities = priorities
+        self.datadir_cache = datadir_cache
+        self.reset_databases = reset_databases or ()
+        self.snapshot_init(setup, snapshotIdent)
         MongoMultiNodeLayer.__init__(self, name,
             mongod_bin = mongod_bin,
             hostname = hostname, storage_port_base = storage_port_base,
-            count = count, cleanup = cleanup)
+            count = count, cleanup = cleanup, density = density)
 
     def create_layers(self):
         """
@@ -404,7 +1275,8 @@ class MongoReplicaSetLayer(MongoMultiNodeLayer):
             }
             mongo = MongoLayer(layer_name,
                 mongod_bin = self.mongod_bin, storage_port = storage_port,
-                cleanup = self.cleanup, extra_options = extra_options)
+                cleanup = self.cleanup, extra_options = extra_options,
+                density = self.node_density)
             self.layers.append(mongo)
 
         # final layer for establishing the replica set which will be set up
@@ -414,7 +1286,87 @@ class MongoReplicaSetLayer(MongoMultiNodeLayer):
         # this one can reach the other - previously booted - nodes immediately
         self.layers.append(
             MongoReplicaSetInitLayer(self.name + '.init', self.replicaset_name,
-                self.storage_ports))
+                self.storage_ports, hostname = self.hostname,
+                election_timeout = self.election_timeout,
+                priorities = self.priorities))
+
+        if self.datadir_cache:
+            for mongo in self.layers[:-1]:
+                mongo.seed_path = os.path.join(
+                    self.datadir_cache_path, str(mongo.storage_port))
+
+    @property
+    def datadir_cache_key(self):
+        """
+        The data directories depend on the replica set name, the
+        addresses of the members, the version of ``mongod``, the options
+        of the nodes and the replica set configuration.
+        """
+        nodes, init = self.layers[:-1], self.layers[-1]
+        ident = [self.replicaset_name, self.hostname, self.storage_ports,
+                 nodes[0].mongod_version,
+                 sorted(init.replicaset_initiate_options().items())]
+        for node in nodes:
+            # the paths of the work directory do not matter
+            options = node.mongod_arguments()
+            for name in node.default_options:
+                if name != 'port':
+                    options.pop(name)
+            ident.append(sorted(options.items()))
+        return hashlib.sha1(repr(ident)).hexdigest()
+
+    @property
+    def datadir_cache_path(self):
+        return os.path.join(util.CACHE, 'mongodb', self.datadir_cache_key)
+
+    def setUp(self):
+        """
+        Set up the test layer. All nodes are running and the replica set
+        is established, cache the data directories if requested.
+        """
+        if self.datadir_cache and not os.path.isdir(self.datadir_cache_path):
+            self.cache_datadirs()
+        self.snapshot_setup()
+
+    def tearDown(self):
+        self.reset_release()
+
+    @property
+    def reset_hosts(self):
+        return ['{0}:{1}'.format(self.hostname, port)
+                for port in self.storage_ports]
+
+    @property
+    def snapshot_version(self):
+        return self.layers[0].mongod_version
+
+    @property
+    def snapshot_host(self):
+        return '%s/%s' % (self.replicaset_name, ','.join(self.reset_hosts))
+
+    @property
+    def snapshot_dir(self):
+        return self.snapDir or os.path.join(layer.BASE, '.'.join(
+            (self.__class__.__module__, self.__class__.__name__, self.name)))
+
+    def cache_datadirs(self):
+        """
+        Stop all nodes to copy their data directories into the cache,
+        then boot the replica set again.
+        """
+        nodes, init = self.layers[:-1], self.layers[-1]
+        for node in nodes:
+            node.stop()
+        def create(tree):
+            for node in nodes:
+                util.copytree(node.var_path,
+                    os.path.join(tree, str(node.storage_port)))
+        try:
+            util.cache_tree('mongodb', self.datadir_cache_key, create)
+        finally:
+            for node in nodes:
+                node.start()
+            init.replicaset_boot()
 
     def _get_replset_option(self, exclude=None):
         """
@@ -431,6 +1383,331 @@ class MongoReplicaSetLayer(MongoMultiNodeLayer):
         return '%s/%s' % (self.replicaset_name, ','.join(nodelist))
 
 
+class MongosLayer(MongoLayer):
+    """
+    Encapsulates controlling a ``mongos`` router of a sharded cluster.
+    """
+
+    def __init__(self, name, configdb, mongos_bin = None,
+                    hostname = 'localhost', storage_port = 37017,
+                    cleanup = True, extra_options = None):
+        """
+        Settings for ``MongosLayer``
+
+        :name: (required)
+            The first positional argument is the layer name
+
+        :configdb: (required)
+            The address of the config server replica set,
+            ``<replicasetname>/<hostname1:port1>,<hostname2:port2>``,
+            before MongoDB 3.2 the addresses of the config servers
+            ``<hostname1:port1>,<hostname2:port2>,<hostname3:port3>``
+
+        :mongos_bin:
+            The path to ``mongos``, defaults to ``mongos``
+
+        The other settings are the same as for ``MongoLayer``.
+        """
+        self.configdb = configdb
+        MongoLayer.__init__(self, name, mongod_bin = mongos_bin or 'mongos',
+            hostname = hostname, storage_port = storage_port,
+            cleanup = cleanup, extra_options = extra_options)
+
+    def setup_command(self):
+        options = {
+            'port': self.storage_port,
+            'configdb': self.configdb,
+            'pidfilepath': self.pid_file,
+            'logpath': self.log_file,
+        }
+        options.update(self.extra_options)
+        self.start_cmd = '{0} {1}'.format(self.mongod_bin,
+            self._serialize_arguments(options))
+        logger.debug('start_cmd=%s' % self.start_cmd)
+        self.servers = [(self.hostname, self.storage_port)]
+
+
+def run_concurrently(functions):
+    """
+    Call the functions in threads, the first exception raised by any of
+    them is reraised after all threads finished.
+    """
+    errors = []
+    def run(function):
+        try:
+            function()
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(function,))
+               for function in functions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+class MongoShardingLayer(MongoMultiNodeLayer):
+
+    def __init__(self, name,
+            mongod_bin = None, mongos_bin = None,
+            hostname = 'localhost', storage_port_base = 37100,
+            shards = 2, shard_size = 1, config_size = 1,
+            cleanup = True, density = False):
+        """
+        Make a ``MongoShardingLayer`` from a ``MongoMultiNodeLayer``
+
+        All nodes are started concurrently, afterwards the config server
+        replica set and the shard replica sets are initiated concurrently.
+        Once the config servers are ready ``mongos`` is started and the
+        shards are added to the cluster. Before MongoDB 3.2 the config
+        servers are standalone servers instead of a replica set.
+
+        :name: (required)
+            The first and only positional argument is the layer name.
+
+        :mongod_bin:
+            The path to ``mongod``, defaults to ``mongod``
+
+        :mongos_bin:
+            The path to ``mongos``, defaults to ``mongos`` next to
+            ``mongod``
+
+        :hostname:
+            The hostname to be used for:
+                - adding MongoDB nodes to the cluster
+                - connecting to a MongoDB node from Python
+            Defaults to ``localhost``
+
+        :storage_port_base:
+            At which port to start. The config servers use the first ports,
+            followed by the nodes of the shards, ``mongos`` uses the port
+            after the last node. Defaults to ``37100``
+
+        :shards:
+            How many shards to start, defaults to ``2``
+
+        :shard_size:
+            How many nodes each shard replica set has, defaults to ``1``
+
+        :config_size:
+            How many nodes the config server replica set has, defaults
+            to ``1``. Before MongoDB 3.2 there are ``1`` or ``3`` config
+            servers.
+
+        :cleanup:
+            Whether to erase the workspace directory on initialization,
+            defaults to ``True``
+
+        :density:
+            Run the nodes with a low footprint, see ``MongoMultiNodeLayer``
+        """
+        if mongos_bin is None and mongod_bin is not None:
+            mongos_bin = os.path.join(os.path.dirname(mongod_bin), 'mongos')
+        self.mongos_bin = mongos_bin
+        self.shards = shards
+        self.shard_size = shard_size
+        self.config_size = config_size
+        MongoMultiNodeLayer.__init__(self, name,
+            mongod_bin = mongod_bin,
+            hostname = hostname, storage_port_base = storage_port_base,
+            count = config_size + shards * shard_size, cleanup = cleanup,
+            density = density)
+        # the components are booted concurrently by setUp instead of
+        # one by one as bases by the test runner
+        self.__bases__ = ()
+
+    @property
+    def config_name(self):
+        return '%s.config' % self.name
+
+    def shard_name(self, number):
+        return '%s.shard%s' % (self.name, number + 1)
+
+    @property
+    def config_replicaset(self):
+        """
+        Whether the config servers form a replica set, which is supported
+        since MongoDB 3.2 and required since 3.4.
+        """
+        return self.layers[0].mongod_version >= (3, 2)
+
+    def create_layers(self):
+        """
+        Create the layers of all components:
+        - The nodes of the config servers and of the shards.
+        - One ``MongoReplicaSetInitLayer`` for each replica set.
+        - The ``mongos`` router.
+        """
+        options = list(self.layer_options)
+        self.replicasets = []
+        for number in range(self.shards + 1):
+            if number == 0:
+                name = self.config_name
+                members = options[:self.config_size]
+                role = {'configsvr': True}
+            else:
+                name = self.shard_name(number - 1)
+                start = self.config_size + (number - 1) * self.shard_size
+                members = options[start:start + self.shard_size]
+                role = {'shardsvr': True}
+            nodes = []
+            for layer_name, storage_port in members:
+                nodes.append(MongoLayer(layer_name,
+                    mongod_bin = self.mongod_bin, storage_port = storage_port,
+                    cleanup = self.cleanup, extra_options = dict(role),
+                    density = self.node_density))
+            self.layers.extend(nodes)
+            if number == 0 and not self.config_replicaset:
+                if self.config_size not in (1, 3):
+                    raise ValueError('Before MongoDB 3.2 there are 1 or 3 '
+                                     'config servers')
+                init = None
+            else:
+                for node in nodes:
+                    node.extra_options['replSet'] = name
+                ports = [port for _, port in members]
+                init = MongoReplicaSetInitLayer(name + '.init', name, ports,
+                    hostname = self.hostname, configsvr = number == 0)
+            self.replicasets.append((name, nodes, init))
+
+        self.mongos_port = self.storage_port_base + self.count
+        self.mongos = MongosLayer(self.name + '.mongos',
+            self.config_address, mongos_bin = self.mongos_bin,
+            hostname = self.hostname, storage_port = self.mongos_port,
+            cleanup = self.cleanup)
+
+    @property
+    def config_address(self):
+        """
+        The address of the config servers passed to ``mongos``.
+        """
+        if self.config_replicaset:
+            return self.replicaset_address(0)
+        name, nodes, init = self.replicasets[0]
+        return ','.join(['{0}:{1}'.format(self.hostname, node.storage_port)
+                         for node in nodes])
+
+    def replicaset_address(self, number):
+        """
+        The address of the config server replica set (``0``) or a shard
+        in the form ``<replicasetname>/<hostname1:port1>,...``.
+        """
+        name, nodes, init = self.replicasets[number]
+        return '%s/%s' % (name, ','.join(['{0}:{1}'.format(
+            self.hostname, node.storage_port) for node in nodes]))
+
+    def setUp(self):
+        t = time.time()
+        run_concurrently([node.setUp for node in self.layers])
+        def config():
+            init = self.replicasets[0][2]
+            if init is not None:
+                init.setUp()
+            self.mongos.setUp()
+        run_concurrently([config] +
+            [init.setUp for name, nodes, init in self.replicasets[1:]])
+        self.add_shards()
+        logger.info('Sharded cluster ready after {0:.2f}s!'.format(
+            time.time() - t))
+
+    def tearDown(self):
+        self.mongos.tearDown()
+        run_concurrently([node.tearDown for node in self.layers])
+
+    def connection(self):
+        """
+        Returns a new connection to ``mongos``.
+        """
+        from pymongo import Connection
+        return Connection('{0}:{1}'.format(self.hostname, self.mongos_port),
+                          safe=True)
+
+    def add_shards(self):
+        conn = self.connection()
+        try:
+            existing = [shard['_id'] for shard in
+                        conn.admin.command('listShards')['shards']]
+            for number in range(1, self.shards + 1):
+                name = self.replicasets[number][0]
+                if name in existing:
+                    continue
+                conn.admin.command('addShard', self.replicaset_address(number),
+                                   name = name)
+        finally:
+            conn.disconnect()
+
+    def shard_collection(self, namespace, key, unique = False):
+        """
+        Enable sharding for the database of ``namespace`` and shard the
+        collection by ``key``, e.g. ``{'user_id': 1}``.
+        """
+        conn = self.connection()
+        try:
+            db_name = namespace.split('.', 1)[0]
+            # fails if sharding is enabled already
+            conn.admin.command('enableSharding', db_name, check = False)
+            conn.admin.command('shardCollection', namespace, key = key,
+                               unique = unique)
+        finally:
+            conn.disconnect()
+
+    def presplit(self, namespace, points, distribute = True):
+        """
+        Split the chunks of a sharded collection at the given shard key
+        values, e.g. ``[{'user_id': 1000}, {'user_id': 2000}]``. With
+        ``distribute`` the chunks are moved to the shards round robin, the
+        first chunk to the first shard, the chunk starting at the first
+        point to the second shard and so on.
+        """
+        from bson.son import SON
+        from bson.min_key import MinKey
+        conn = self.connection()
+        try:
+            for point in points:
+                conn.admin.command('split', namespace, middle = point)
+            if distribute and points:
+                # the first chunk starts at the lowest possible key
+                first = SON([(key, MinKey()) for key in points[0]])
+                for number, point in enumerate([first] + list(points)):
+                    shard = self.shard_name(number % self.shards)
+                    result = conn.admin.command('moveChunk', namespace,
+                        find = point, to = shard, check = False)
+                    # the chunk may be on the target shard already
+                    if not result.get('ok') and \
+                        'already' not in result.get('errmsg', ''):
+                        raise MongoShardingError(
+                            'Could not move chunk {0}: {1}'.format(
+                                point, result.get('errmsg')))
+        finally:
+            conn.disconnect()
+
+    def chunk_distribution(self, namespace):
+        """
+        Returns the number of chunks of a collection by shard.
+        """
+        conn = self.connection()
+        try:
+            config = conn['config']
+            query = {'ns': namespace}
+            if not config.chunks.find_one(query):
+                # since 5.0 chunks reference the collection by uuid
+                collection = config.collections.find_one({'_id': namespace})
+                query = {'uuid': collection and collection.get('uuid')}
+            distribution = {}
+            for chunk in config.chunks.find(query):
+                distribution.setdefault(chunk['shard'], 0)
+                distribution[chunk['shard']] += 1
+            return distribution
+        finally:
+            conn.disconnect()
+
+
+class MongoShardingError(Exception):
+    pass
+
+
 class MongoReplicasetInitError(Exception):
     pass
 
@@ -442,18 +1719,21 @@ class MongoReplicasetNodenameError(Exception):
 class MongoReplicaSetInitLayer(object):
     """
     A helper layer for establishing the replica set:
-        - Periodically checks ``replSetGetStatus``
-        - Waits until all nodes are up
+        - Waits until all nodes answer ``isMaster``
         - Runs ``replSetInitiate`` if necessary
-        - Waits until
+        - Polls ``replSetGetStatus`` until
             - replica set initialization took place
             - all cluster nodes established their roles (PRIMARY|SECONDARY)
+
+    One connection per node is kept open while booting, polling
+    backs off adaptively up to ``poll_interval``.
     """
 
     __bases__ = ()
 
     def __init__(self, name, replicaset_name, ports,
-            timeout = 60, hostname='localhost'):
+            timeout = 60, hostname='localhost', poll_interval = 0.1,
+            election_timeout = None, priorities = None, configsvr = False):
         """
         :name: (required)
             The first and only positional argument is the layer name
@@ -470,13 +1750,36 @@ class MongoReplicaSetInitLayer(object):
         :timeout:
             How long to wait for the replica set to be established,
             defaults to ``60`` seconds
+
+        :poll_interval:
+            The maximum delay between two status checks in seconds,
+            defaults to ``0.1``
+
+        :election_timeout:
+            ``electionTimeoutMillis`` of the replica set configuration,
+            a low value speeds up the first election. Defaults to the
+            setting of ``mongod``
+
+        :priorities:
+            Optional list of member priorities in the order of ``ports``,
+            the member with the highest priority becomes ``PRIMARY``
+
+
+        :configsvr:
+            Whether the replica set holds the config servers of a sharded
+            cluster, defaults to ``False``
         """
         self.__name__ = name
         self.replicaset_name = replicaset_name
         self.ports = ports
         self.timeout = timeout
         self.hostname = hostname
+        self.poll_interval = poll_interval
+        self.election_timeout = election_timeout
+        self.priorities = priorities
+        self.configsvr = configsvr
         self.starttime = 0
+        self.connections = {}
         logger.info('Initializing MongoReplicaSetInitLayer')
 
     def setUp(self):
@@ -495,26 +1798,36 @@ class MongoReplicaSetInitLayer(object):
     def replicaset_boot(self):
         """
         Waits for the replica set to be established by
-        periodically checking the replica set status.
+        checking the state of the nodes until they are ready.
         Also accounts for timeout.
         """
 
-        logger.info('Waiting for replica set to be fully initialized, ' +
-                    'this might take up to one minute.')
-        # wait for nodes to settle, damn timing-issues
-        time.sleep(3)
-
+        logger.info('Waiting for replica set to be fully initialized')
         self.starttime = time.time()
+        try:
+            self.wait_for(self.members_up)
 
-        if not self.replicaset_initiate():
-            msg = 'Could not initiate the replica set'
-            logger.error(msg)
-            raise MongoReplicasetInitError(msg)
+            if not self.replicaset_initiate():
+                msg = 'Could not initiate the replica set'
+                logger.error(msg)
+                raise MongoReplicasetInitError(msg)
 
-        while not self.replicaset_ready:
+            self.wait_for(lambda: self.replicaset_ready)
+        finally:
+            self.disconnect()
+        logger.info('Replica set ready after {0:.2f}s!'.format(
+            time.time() - self.starttime))
+
+    def wait_for(self, condition):
+        """
+        Call ``condition`` until it returns a true value, the delay
+        between two calls is doubled up to ``poll_interval``.
+        """
+        delay = 0.01
+        while not condition():
             self.check_timeout()
-            time.sleep(1)
-        logger.info('Replica set ready!')
+            time.sleep(delay)
+            delay = min(delay * 2, self.poll_interval)
 
     def check_timeout(self):
         """
@@ -526,44 +1839,86 @@ class MongoReplicaSetInitLayer(object):
             logger.error(msg)
             raise MongoReplicasetInitError(msg)
 
+    def connection(self, port):
+        """
+        Returns the persistent connection to the node on ``port`` or
+        ``None`` if the node is not reachable yet.
+        """
+        from pymongo import Connection
+        from pymongo.errors import ConnectionFailure
+        if port not in self.connections:
+            host = '{0}:{1}'.format(self.hostname, port)
+            try:
+                self.connections[port] = Connection(host, safe=True)
+            except ConnectionFailure:
+                return None
+        return self.connections[port]
+
+    def command(self, port, *args, **kwargs):
+        """
+        Run an admin command on the node on ``port``, returns ``None``
+        if the node is not reachable. The connection is dropped on
+        errors so it gets reestablished on the next call.
+        """
+        from pymongo.errors import ConnectionFailure
+        conn = self.connection(port)
+        if conn is None:
+            return None
+        try:
+            return conn.admin.command(*args, **kwargs)
+        except ConnectionFailure:
+            self.connections.pop(port).disconnect()
+            return None
+
+    def disconnect(self):
+        while self.connections:
+            self.connections.popitem()[1].disconnect()
+
+    def members_up(self):
+        """
+        Returns ``True`` if all nodes answer ``isMaster``.
+        """
+        return all([self.command(port, 'isMaster') is not None
+                    for port in self.ports])
+
     def replicaset_initiate(self):
         """
         call replSetInitiate on one of the nodes of our replicaset in spe
         providing all the other nodes as options
         """
-        from pymongo import Connection
-        host = '{0}:{1}'.format(self.hostname, self.ports[-1])
+        from pymongo.errors import OperationFailure
+        port = self.ports[-1]
         logger.info("Initiating replica set '{0}'".format(
             self.replicaset_name))
 
         command = 'replSetInitiate'
 
         try:
-            mongo_conn = Connection(host, safe=True)
             # we are not interested in eventual errors
-            status = mongo_conn.admin.command('replSetGetStatus', check=False)
+            status = self.command(port, 'replSetGetStatus', check=False)
+            if status is None:
+                return False
             if status.get("set") == self.replicaset_name:
-                if status.get("myState") in (1, 2) and \
-                    len(status.get("members", [])) == len(self.ports):
-
-                    logger.info("Replica set already initiated")
-                    #logger.info(status)
-                    return True
-                else:
-                    #logger.info(status)
-                    return False
-
-            result = mongo_conn.admin.command(
-                command, self.replicaset_initiate_options())
-            if result.get("ok") == 1.0:
+                logger.info("Replica set already initiated")
+                return True
+
+            result = self.command(
+                port, command, self.replicaset_initiate_options(),
+                check=False)
+            if result is not None and result.get("ok") == 1.0:
                 logger.info(
                     "Initiated replica set: '{0}'".format(result.get("info")))
                 return True
+            elif result is not None and \
+                'already initialized' in result.get("errmsg", ""):
+                # the configuration got loaded from a cached data directory
+                logger.info("Replica set already initiated")
+                return True
             else:
                 logger.warning(
                     "Could not initiate replica set, result={0}".format(result))
 
-        except Exception, msg:
+        except OperationFailure, msg:
             logger.error(
                 "Could not initiate replica set, exception is '{0}'".format(msg))
 
@@ -574,11 +1929,20 @@ class MongoReplicaSetInitLayer(object):
             "_id": self.replicaset_name,
             "members": [],
         }
-        for port in self.ports:
-            options["members"].append({
+        for number, port in enumerate(self.ports):
+            member = {
                 '_id': port - self.ports[0],
                 'host': '{0}:{1}'.format(self.hostname, port),
-            })
+            }
+            if self.priorities is not None:
+                member['priority'] = self.priorities[number]
+            options["members"].append(member)
+        if self.configsvr:
+            options["configsvr"] = True
+        if self.election_timeout is not None:
+            options["settings"] = {
+                'electionTimeoutMillis': self.election_timeout,
+            }
         logger.debug(options)
         return options
 
@@ -591,24 +1955,24 @@ class MongoReplicaSetInitLayer(object):
         Returns ``True`` if replica set is fully established.
         """
 
-        from pymongo import Connection
         from pymongo.errors import OperationFailure
-        host = '{0}:{1}'.format(self.hostname, self.ports[-1])
-        mongo_conn = Connection(host, safe = True)
 
         try:
-            result = mongo_conn.admin.command('replSetGetStatus', check=False)
-            startup_status = result.get('startupStatus')
-            replset_name = result.get('set')
+            result = self.command(self.ports[-1], 'replSetGetStatus',
+                                  check=False)
         except OperationFailure, msg:
             logger.error(msg)
             return False
+        if result is None:
+            return False
+        startup_status = result.get('startupStatus')
+        replset_name = result.get('set')
 
         success = False
 
         # cluster is still booting
         if startup_status:
-            logger.info("startup_status=%s %s" %
+            logger.debug("startup_status=%s %s" %
                 (startup_status, result.get('errmsg')))
 
         # replica set is initiated, check that all member
@@ -616,7 +1980,7 @@ class MongoReplicaSetInitLayer(object):
         elif replset_name:
             member_states = [member.get('stateStr')
                                 for member in result.get('members')]
-            logger.info(
+            logger.debug(
                 'name={replset_name}, nodes={member_states}'.format(**locals()))
             logger.debug(
                 '{0} of {1} nodes are up'.format(
@@ -630,5 +1994,4 @@ class MongoReplicaSetInitLayer(object):
 
             success = primary_up and secondaries_up and all_up
 
-        mongo_conn.disconnect()
         return success
@@ -21,6 +21,13 @@ import os
 import hashlib
 import time
 import tempfile
+import shutil
+import re
+import socket
+import subprocess
+import threading
+import multiprocessing
+from collections import deque
 import _mysql
 from lovely.testlayers import util
 from lovely.testlayers import sql
@@ -28,17 +35,116 @@ from lovely.testlayers import sql
 
 BASE = os.path.join(tempfile.gettempdir(), __name__)
 
+# first line of the manifest of snapshots dumped per table
+TAB_HEADER = '-- lovely.testlayers tab snapshot'
+# the triggers and routines of a tab snapshot, created after loading the
+# data so the triggers do not fire during the restore
+TAB_POST = 'ltl-post.sql'
+
+# virtual schemas which are not reported as databases
+SYSTEM_SCHEMAS = ('information_schema', 'performance_schema')
+
+# server profile generated by fastTestConf
+PROFILE_FAST = 'fast'
+PROFILES = (PROFILE_FAST,)
+
+TMPFS = '/dev/shm'
+
+
+def _confLine(lines, name, value):
+    if value is None:
+        return
+    if value is True:
+        lines.append(name)
+    else:
+        lines.append('%s = %s' % (name, value))
+
+
+def fastTestConf(mysqlVersion, settings=None, memory=None, include=None,
+                 tmpdir=None):
+    """generates a my.cnf for running tests
+
+    Durability and the binary log are turned off, the buffer pool is
+    derived from the memory of the host and temporary tables are written
+    to tmpfs if it is available. The given settings override the
+    generated ones, a value of True is written as a flag and None
+    removes a setting. An included
+    defaults file is read last, so its settings win.
+
+    >>> print fastTestConf((8, 0, 21), {'max_connections': 50},
+    ...                    memory=4096*1024**2, include='/etc/my.cnf',
+    ...                    tmpdir='/dev/shm')
+    [mysqld]
+    innodb_flush_log_at_trx_commit = 0
+    innodb_doublewrite = 0
+    innodb_buffer_pool_size = 128M
+    performance_schema = 0
+    tmpdir = /dev/shm
+    skip-log-bin
+    max_connections = 50
+    !include /etc/my.cnf
+
+    The performance schema exists since mysql 5.5.3.
+
+    >>> print fastTestConf((5, 1, 73), {}, memory=4096*1024**2, tmpdir='')
+    [mysqld]
+    innodb_flush_log_at_trx_commit = 0
+    innodb_doublewrite = 0
+    innodb_buffer_pool_size = 128M
+    """
+    if memory is None:
+        memory = util.physical_memory() or 1024**3
+    if tmpdir is None and os.path.isdir(TMPFS):
+        tmpdir = TMPFS
+    mb = memory // 1024**2
+    conf = [('innodb_flush_log_at_trx_commit', 0),
+            ('innodb_doublewrite', 0),
+            ('innodb_buffer_pool_size', '%sM' % min(max(mb // 32, 32), 512))]
+    if mysqlVersion >= (5, 5, 3):
+        # older servers refuse to start with the unknown option
+        conf.append(('performance_schema', 0))
+    if tmpdir:
+        conf.append(('tmpdir', tmpdir))
+    if mysqlVersion >= (8, 0):
+        # the binary log is enabled by default since 8.0
+        conf.append(('skip-log-bin', True))
+    settings = dict(settings or {})
+    lines = ['[mysqld]']
+    for name, value in conf:
+        _confLine(lines, name, settings.pop(name, value))
+    for name, value in sorted(settings.items()):
+        _confLine(lines, name, value)
+    if include:
+        lines.append('!include %s' % include)
+    return '\n'.join(lines)
+
+
+def _copyTable(execute, source, target, table):
+    """copies the definition and rows of a table into another schema"""
+    execute('DROP TABLE IF EXISTS `%s`.`%s`' % (target, table))
+    execute('CREATE TABLE `%s`.`%s` LIKE `%s`.`%s`' % (
+        target, table, source, table))
+    execute('INSERT INTO `%s`.`%s` SELECT * FROM `%s`.`%s`' % (
+        target, table, source, table))
+
 
 class Server(sql.ServerBase):
     """ Class to control a mysql server"""
 
     def __init__(self, dbDir=None, host='127.0.0.1', port=6543,
                  defaults_file=None,
-                 mysql_bin_dir=None):
+                 mysql_bin_dir=None, tabSnapshots=False,
+                 restoreWorkers=None, profile=None, profileSettings=None):
+        if profile is not None and profile not in PROFILES:
+            raise ValueError, "Unknown profile %r" % profile
         self.port = port
         self.host = host
         self.dbDir = dbDir
         self.defaults_file = defaults_file
+        self.profile = profile
+        self.profileSettings = profileSettings
+        self.tabSnapshots = tabSnapshots
+        self.restoreWorkers = restoreWorkers or multiprocessing.cpu_count()
 
         self.cmd_post_fix = ''
         if not mysql_bin_dir:
@@ -66,10 +172,38 @@ class Server(sql.ServerBase):
             # try in the scripts dir (mysql 5.5)
             cmd = os.path.join(self.scripts_dir, name)
             cmd += ' --basedir="%s"' % os.path.dirname(self.bin_dir)
-        if self.defaults_file:
-            cmd += ' --defaults-file="%s"' % self.defaults_file
+        if self.defaultsFile:
+            cmd += ' --defaults-file="%s"' % self.defaultsFile
         return cmd
 
+    @property
+    def startConfig(self):
+        return (self.bin_dir, self.defaults_file, self.profile,
+                sorted((self.profileSettings or {}).items()))
+
+    @property
+    def profilePath(self):
+        return self.dbDir + '.cnf'
+
+    @property
+    def defaultsFile(self):
+        """the defaults file passed to the server and clients"""
+        if self.profile is not None:
+            return self.profilePath
+        return self.defaults_file
+
+    def _writeProfile(self):
+        if self.profile is None:
+            return
+        conf = fastTestConf(self.serverVersion, self.profileSettings,
+                            include=self.defaults_file)
+        parent = os.path.dirname(self.profilePath)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+        f = open(self.profilePath, 'w')
+        f.write(conf)
+        f.close()
+
     @property
     def mysql(self):
         cmd = "%s --user=root --port=%i --host=%s --protocol=tcp -s "
@@ -85,32 +219,262 @@ class Server(sql.ServerBase):
         cmd = "%s --user=root --port=%i --host=%s --protocol=tcp --routines"
         return cmd % (self.cmd('mysqldump'), self.port, self.host)
 
+    adminErrors = (_mysql.OperationalError, _mysql.InterfaceError)
+
+    def _connectAdmin(self):
+        conn = _mysql.connect(host=self.host, port=self.port, user='root')
+        conn.autocommit(True)
+        return conn
+
+    def _executeAdmin(self, conn, stmt, args):
+        if args:
+            stmt = stmt % tuple([conn.escape_string(str(a)) for a in args])
+        conn.query(stmt)
+        result = conn.store_result()
+        if result is None:
+            return []
+        return list(result.fetch_row(maxrows=0))
+
+    def _connectionLost(self, conn):
+        try:
+            conn.ping()
+        except self.adminErrors:
+            return True
+        return False
+
     def createDB(self, dbName):
-        cmd = "%s -e 'CREATE DATABASE %s'" % (self.mysql, dbName)
-        util.system(cmd)
+        self.execute('CREATE DATABASE `%s`' % dbName)
 
     def dropDB(self, dbName):
-        if not dbName in self.listDatabases():
-            return
-        cmd = "%s -e 'DROP DATABASE %s'" % (self.mysql, dbName)
-        util.system(cmd)
+        self.execute('DROP DATABASE IF EXISTS `%s`' % dbName)
+
+    def _checksums(self, dbName, tables):
+        if not tables:
+            return {}
+        rows = self.execute('CHECKSUM TABLE %s' % ', '.join(
+            ['`%s`.`%s`' % (dbName, t) for t in tables]))
+        return dict([(name.split('.', 1)[1], checksum)
+                     for name, checksum in rows])
+
+    resetStrategies = sql.RESET_STRATEGIES
+
+    def _baseTables(self, dbName):
+        return [t for t, kind in self.execute(
+            "SHOW FULL TABLES FROM `%s` WHERE Table_type = 'BASE TABLE'" % (
+            dbName))]
+
+    def _triggered(self, dbName):
+        """the tables with triggers, which would fire if their rows get
+        reloaded"""
+        return set([t for t, in self.execute(
+            "SELECT event_object_table FROM information_schema.triggers "
+            "WHERE event_object_schema = '%s'", (dbName,))])
+
+    def _autoIncrement(self, dbName):
+        return dict(self.execute(
+            "SELECT table_name, auto_increment FROM information_schema.tables "
+            "WHERE table_schema = '%s' AND auto_increment IS NOT NULL",
+            (dbName,)))
+
+    def captureTables(self, dbName, strategy=sql.RESET_TRUNCATE):
+        """captures the rows of all tables with SELECT INTO OUTFILE into a
+        temporary directory, modified tables are detected by checksums"""
+        if strategy == sql.RESET_SHADOW:
+            return self._captureShadow(dbName)
+        tables = self._baseTables(dbName)
+        path = tempfile.mkdtemp(prefix='%s_' % dbName)
+        for t in tables:
+            self.execute("SELECT * INTO OUTFILE '%s' FROM `%s`.`%s`" % (
+                os.path.join(path, t + '.txt'), dbName, t))
+        return dict(strategy=strategy, path=path,
+                    checksums=self._checksums(dbName, tables),
+                    autoIncrement=self._autoIncrement(dbName),
+                    triggered=self._triggered(dbName))
+
+    def _captureShadow(self, dbName):
+        """copies all tables into the shadow schema. Tables which are not
+        bound to their schema by foreign keys or triggers are also copied
+        into a spare schema in the background, so they can be swapped in
+        by RENAME TABLE"""
+        tables = self._baseTables(dbName)
+        shadow = dbName + '__shadow'
+        spare = dbName + '__shadow_spare'
+        for name in (shadow, spare):
+            self.dropDB(name)
+            self.createDB(name)
+        for t in tables:
+            _copyTable(self.execute, dbName, shadow, t)
+        bound = set()
+        for child, parent in self.execute(
+            "SELECT table_name, referenced_table_name "
+            "FROM information_schema.key_column_usage "
+            "WHERE table_schema = '%s' AND referenced_table_name IS NOT NULL",
+            (dbName,)):
+            bound.update((child, parent))
+        triggered = self._triggered(dbName)
+        bound.update(triggered)
+        data = dict(strategy=sql.RESET_SHADOW, shadow=shadow, spare=spare,
+                    checksums=self._checksums(dbName, tables),
+                    autoIncrement=self._autoIncrement(dbName),
+                    triggered=triggered, ready=set(), refill=None)
+        self._refillSpare(data, [t for t in tables if t not in bound])
+        return data
+
+    def _refillSpare(self, data, tables):
+        """copies the given tables from the shadow into the spare schema
+        in a background thread"""
+        def refill():
+            conn = self._connectAdmin()
+            execute = lambda stmt: self._executeAdmin(conn, stmt, None)
+            try:
+                for t in tables:
+                    execute('DROP TABLE IF EXISTS `%s`.`%s__old`' % (
+                        data['spare'], t))
+                    _copyTable(execute, data['shadow'], data['spare'], t)
+                    data['ready'].add(t)
+            finally:
+                conn.close()
+        thread = threading.Thread(target=refill, name=data['spare'])
+        thread.setDaemon(True)
+        thread.start()
+        data['refill'] = thread
+
+    def _joinRefill(self, data):
+        thread = data.get('refill')
+        if thread is not None:
+            thread.join()
+            data['refill'] = None
+
+    def reloadTables(self, dbName, data):
+        """truncates the modified tables and reloads their captured rows
+
+        mysql can not disable triggers, they would fire while the rows
+        are reloaded. If a modified table has triggers the snapshot needs
+        to be restored instead.
+        """
+        checksums = self._checksums(dbName, data['checksums'].keys())
+        dirty = [t for t, checksum in data['checksums'].items()
+                 if checksums.get(t) != checksum]
+        if not dirty:
+            return True
+        if data['triggered'].intersection(dirty):
+            return False
+        if data['strategy'] == sql.RESET_SHADOW:
+            return self._reloadShadow(dbName, data, dirty)
+        self.execute('SET FOREIGN_KEY_CHECKS = 0')
+        try:
+            for t in dirty:
+                self.execute('TRUNCATE TABLE `%s`.`%s`' % (dbName, t))
+                self.execute("LOAD DATA INFILE '%s' INTO TABLE `%s`.`%s`" % (
+                    os.path.join(data['path'], t + '.txt'), dbName, t))
+                self._resetAutoIncrement(dbName, data, t)
+        finally:
+            self.execute('SET FOREIGN_KEY_CHECKS = 1')
+        return True
+
+    def _reloadShadow(self, dbName, data, dirty):
+        """swaps the modified tables with their spare copies in a single
+        RENAME TABLE, tables without a spare copy are refilled in place
+        from the shadow schema. The spare copies of the swapped tables are
+        rebuilt in the background"""
+        self._joinRefill(data)
+        spare = data['spare']
+        swapped = [t for t in dirty if t in data['ready']]
+        self.execute('SET FOREIGN_KEY_CHECKS = 0')
+        try:
+            if swapped:
+                renames = []
+                for t in swapped:
+                    renames.append('`%s`.`%s` TO `%s`.`%s__old`' % (
+                        dbName, t, spare, t))
+                    renames.append('`%s`.`%s` TO `%s`.`%s`' % (
+                        spare, t, dbName, t))
+                self.execute('RENAME TABLE %s' % ', '.join(renames))
+                data['ready'].difference_update(swapped)
+            for t in dirty:
+                if t not in swapped:
+                    self.execute('TRUNCATE TABLE `%s`.`%s`' % (dbName, t))
+                    self.execute(
+                        'INSERT INTO `%s`.`%s` SELECT * FROM `%s`.`%s`' % (
+                        dbName, t, data['shadow'], t))
+                self._resetAutoIncrement(dbName, data, t)
+        finally:
+            self.execute('SET FOREIGN_KEY_CHECKS = 1')
+        if swapped:
+            self._refillSpare(data, swapped)
+        return True
+
+    def _resetAutoIncrement(self, dbName, data, table):
+        if table in data['autoIncrement']:
+            self.execute('ALTER TABLE `%s`.`%s` AUTO_INCREMENT = %s' % (
+                dbName, table, data['autoIncrement'][table]))
+
+    def releaseTables(self, data):
+        if data['strategy'] == sql.RESET_SHADOW:
+            self._joinRefill(data)
+            self.dropDB(data['shadow'])
+            self.dropDB(data['spare'])
+        else:
+            shutil.rmtree(data['path'], ignore_errors=True)
 
-    def runScripts(self, dbName, scripts):
-        """runs sql scripts from given paths"""
-        for script in scripts:
-            script = self.resolveScriptPath(script)
-            cmd = "%s %s < %s" % (self.mysql, dbName, script)
-            util.system(cmd)
+    def runScripts(self, dbName, scripts, transaction=False):
+        """runs sql scripts from given paths in a single mysql session"""
+        paths = [self.resolveScriptPath(script) for script in scripts]
+        if self.serverVersion >= (5, 6, 4):
+            now = 'SYSDATE(6)'
+        else:
+            # fractional seconds are supported since 5.6.4
+            now = 'SYSDATE()'
+        mark = "SELECT '%s', UNIX_TIMESTAMP(%s);" % (sql.SCRIPT_MARK, now)
+        lines = [mark]
+        if transaction:
+            lines.append('SET autocommit=0;')
+        for path in paths:
+            lines.append('source %s;' % path)
+            lines.append(mark)
+        if transaction:
+            lines.append('COMMIT;')
+        cmd = "%s -N %s" % (self.mysql, dbName)
+        p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE)
+        output = p.communicate('\n'.join(lines) + '\n')[0]
+        if p.returncode:
+            raise SystemError("Failed", cmd)
+        self.scriptTimings = sql.scriptTimings(paths, output)
+
+    @property
+    def serverVersion(self):
+        if not hasattr(self, '_serverVersion'):
+            f = os.popen('"%s" --version' % self.mysqld_path())
+            m = re.search(r'Ver (\d+(\.\d+)*)', f.read())
+            f.close()
+            if m is None:
+                raise RuntimeError, "Unable to determine the mysqld version"
+            self._serverVersion = tuple(map(int, m.group(1).split('.')))
+        return self._serverVersion
 
     def initDB(self):
-        if not os.path.exists(self.dbDir):
-            os.makedirs(self.dbDir)
-        cmd = "%s --ldata=%s" % (self.cmd('mysql_install_db'), self.dbDir)
         t = time.time()
-        util.system(cmd)
+        self._writeProfile()
+        if self.clusterCache:
+            ident = [self.bin_dir, self.serverVersion]
+            if self.defaultsFile:
+                f = open(self.defaultsFile)
+                ident.append(f.read())
+                f.close()
+            key = hashlib.sha1(repr(ident)).hexdigest()
+            util.cached_tree('mysql', key, self.dbDir, self._installDB)
+        else:
+            self._installDB(self.dbDir)
         print >> sys.stderr, "INITDB: %r in %s secs" % (self.dbDir,
                                                         time.time()-t)
 
+    def _installDB(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        cmd = "%s --ldata=%s" % (self.cmd('mysql_install_db'), path)
+        util.system(cmd)
+
     def mysqld_path(self):
         # search for relative libexec
         daemon_path = os.path.join(self.bin_dir, 'mysqld')
@@ -124,55 +488,158 @@ class Server(sql.ServerBase):
             f.close()
         return daemon_path
 
+    process = None
+    # seconds to wait for a shutdown before mysqld gets terminated and
+    # killed
+    stopTimeout = 60
+    termTimeout = 10
+
+    @property
+    def socketPath(self):
+        return os.path.join(self.dbDir, 'mysql.sock')
+
+    def isListening(self):
+        """checks if mysqld accepts connections on its unix socket"""
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            return s.connect_ex(self.socketPath) == 0
+        finally:
+            s.close()
+
+    def _wait(self, listening, timeout=60):
+        delay = 0.005
+        t = time.time() + timeout
+        while self.isListening() != listening:
+            if listening and self.process is not None:
+                rc = self.process.poll()
+                if rc is not None:
+                    raise SystemError("mysqld exited rc=%s, see %s" % (
+                        rc, self.logPath))
+            if time.time() > t:
+                raise SystemError("Timeout waiting for mysqld at %s" % (
+                    self.socketPath))
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    @property
+    def logPath(self):
+        return os.path.join(self.dbDir, 'mysqld.log')
+
     def start(self):
         daemon_path = self.mysqld_path()
         if not daemon_path:
             raise IOError, "mysqld was not found. Is a MySQL server installed?"
-        if self.defaults_file:
-            defaults = '--defaults-file="%s"' % self.defaults_file
+        self._writeProfile()
+        if self.defaultsFile:
+            defaults = '--defaults-file=%s' % self.defaultsFile
         else:
             defaults = '--no-defaults'
-        cmd = "%s %s --datadir=%s --port=%i --pid-file=%s/mysql.pid --socket=%s/mysql.sock & > /dev/null 2>&1 " % (
-                               daemon_path, defaults, self.dbDir, self.port, self.dbDir, self.dbDir)
-        util.system(cmd)
-        while not self.isRunning():
-            time.sleep(0.1)
+        cmd = [daemon_path, defaults,
+               '--datadir=%s' % self.dbDir,
+               '--port=%i' % self.port,
+               '--pid-file=%s' % os.path.join(self.dbDir, 'mysql.pid'),
+               '--socket=%s' % self.socketPath]
+        if self.serverVersion >= (5, 7, 6):
+            # snapshots and table captures write and load files in
+            # arbitrary directories, which secure_file_priv restricts to
+            # a single directory by default since 5.7.6
+            cmd.append('--secure-file-priv=')
+        log = open(self.logPath, 'a')
+        try:
+            self.process = subprocess.Popen(cmd, stdout=log,
+                                            stderr=subprocess.STDOUT)
+        finally:
+            log.close()
+        try:
+            self._wait(True)
+        except SystemError:
+            # do not leave a hanging mysqld behind
+            self._terminate(0)
+            raise
 
     def stop(self):
-        cmd = "%s shutdown > /dev/null 2>&1" % self.mysqladmin
-        util.system(cmd)
-        while self.isRunning():
-            time.sleep(0.3)
+        conn = self.adminConnection()
+        if conn is not None:
+            try:
+                if self.serverVersion >= (5, 7, 9):
+                    conn.query('SHUTDOWN')
+                else:
+                    conn.shutdown()
+            except self.adminErrors:
+                # the connection gets closed by the server
+                pass
+        self.closeAdminConnection()
+        if self.process is not None:
+            self._terminate(self.stopTimeout)
+        else:
+            # started by another process
+            self._wait(False, self.stopTimeout)
+
+    def _terminate(self, timeout):
+        """waits timeout seconds for mysqld to exit, then it gets
+        terminated and killed if it is still running after termTimeout
+        seconds"""
+        process = self.process
+        self.process = None
+        for signal in (process.terminate, process.kill):
+            t = time.time() + timeout
+            while process.poll() is None:
+                if time.time() > t:
+                    break
+                time.sleep(0.05)
+            else:
+                return
+            print >> sys.stderr, "MYSQLD: %s pid %s" % (
+                signal.__name__, process.pid)
+            signal()
+            timeout = self.termTimeout
+        process.wait()
 
     def isRunning(self):
-        cmd = "%s ping" % self.mysqladmin
-        o, i , e = os.popen3(cmd)
-        res = i.read()
-        o.close()
-        i.close()
-        e.close()
-        return 'alive' in res
+        try:
+            self.execute('SELECT 1')
+        except (RuntimeError,) + self.adminErrors:
+            return False
+        return True
 
     def listDatabases(self):
-        cmd = "%s -e 'SHOW DATABASES'" % self.mysql
-        f = os.popen(cmd)
-        res = f.read()
-        res = res.split('\n')[1:]
-        dbs = []
-        for l in res:
-            if not l or l.startswith('('):
-                break
-            dbs.append(l.split('|', 1)[0].strip())
-        f.close()
-        return dbs
+        return [name for name, in self.execute('SHOW DATABASES')
+                if name not in SYSTEM_SCHEMAS]
 
     def dump(self, dbName, path):
         assert self.isRunning()
         path = os.path.abspath(path)
+        if self.tabSnapshots:
+            self._dumpTab(dbName, path)
+            return
         cmd = "%s -r %s %s" % (self.mysqldump, path, dbName)
         print >> sys.stderr, "DUMP: %r" % cmd
         util.system(cmd)
 
+    def _dumpTab(self, dbName, path):
+        """dumps the schema and the data of every table into separate
+        files of a directory, path is a manifest listing the tables"""
+        tabDir = path + '.tab'
+        if os.path.exists(tabDir):
+            shutil.rmtree(tabDir)
+        os.makedirs(tabDir)
+        cmd = "%s --tab=%s --skip-triggers %s" % (self.mysqldump, tabDir,
+                                                  dbName)
+        print >> sys.stderr, "DUMP: %r" % cmd
+        util.system(cmd)
+        # routines are written to stdout in tab mode
+        cmd = "%s --no-create-info --no-data --triggers -r %s %s" % (
+            self.mysqldump, os.path.join(tabDir, TAB_POST), dbName)
+        print >> sys.stderr, "DUMP: %r" % cmd
+        util.system(cmd)
+        # views need to be created after the tables
+        rows = self.execute('SHOW FULL TABLES FROM `%s`' % dbName)
+        tables = [t for t, kind in rows if kind == 'BASE TABLE']
+        tables += [t for t, kind in rows if kind != 'BASE TABLE']
+        f = open(path, 'w')
+        f.write('\n'.join([TAB_HEADER, os.path.basename(tabDir)] + tables))
+        f.close()
+
     def restore(self, dbName, path):
         path = os.path.abspath(path)
         if not os.path.isfile(path):
@@ -182,13 +649,83 @@ class Server(sql.ServerBase):
         self.dropDB(dbName)
         self.createDB(dbName)
 
-        cmd = "%s %s < %s" % (self.mysql, dbName, path)
-        import popen2
-        p = popen2.Popen3(cmd)
-        p.wait()
+        f = open(path)
+        header = f.readline().strip()
+        if header == TAB_HEADER:
+            lines = f.read().split('\n')
+            f.close()
+            tabDir = os.path.join(os.path.dirname(path), lines[0])
+            self._restoreTab(dbName, tabDir, lines[1:])
+        else:
+            f.close()
+            cmd = "%s %s < %s" % (self.mysql, dbName, path)
+            import popen2
+            p = popen2.Popen3(cmd)
+            p.wait()
         print >> sys.stderr, "RESTORED %r in %r secs" % (
             path, time.time()-t)
 
+    def tabDir(self, path):
+        """returns the directory of a tab snapshot or None if path is
+        a plain dump"""
+        f = open(path)
+        try:
+            if f.readline().strip() != TAB_HEADER:
+                return None
+            return os.path.join(os.path.dirname(path),
+                                f.readline().strip())
+        finally:
+            f.close()
+
+    def _restoreTab(self, dbName, tabDir, tables):
+        """creates the tables in one session, loads the data of the
+        tables concurrently and creates the triggers and routines
+        afterwards"""
+        lines = ['SET FOREIGN_KEY_CHECKS=0;']
+        for t in tables:
+            lines.append('source %s;' % os.path.join(tabDir, t + '.sql'))
+        cmd = "%s %s" % (self.mysql, dbName)
+        p = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
+        p.communicate('\n'.join(lines) + '\n')
+        if p.returncode:
+            raise SystemError("Failed", cmd)
+        pending = deque([t for t in tables
+                         if os.path.exists(os.path.join(tabDir, t + '.txt'))])
+        errors = []
+        def load():
+            try:
+                conn = self.newConnection(dbName)
+            except Exception, e:
+                errors.append(e)
+                return
+            try:
+                conn.query('SET FOREIGN_KEY_CHECKS=0')
+                conn.query('SET UNIQUE_CHECKS=0')
+                while True:
+                    try:
+                        t = pending.popleft()
+                    except IndexError:
+                        break
+                    conn.query("LOAD DATA INFILE '%s' INTO TABLE `%s`" % (
+                        os.path.join(tabDir, t + '.txt'), t))
+                    conn.commit()
+            except Exception, e:
+                errors.append(e)
+            finally:
+                conn.close()
+        workers = [threading.Thread(target=load) for i in range(
+            min(self.restoreWorkers, len(pending)))]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        if errors:
+            raise errors[0]
+        post = os.path.join(tabDir, TAB_POST)
+        if os.path.exists(post):
+            cmd = "%s %s < %s" % (self.mysql, dbName, post)
+            util.system(cmd)
+
     def getURI(self, dbName):
         return 'mysql://localhost:%s/%s' % (self.port, dbName)
 
@@ -214,21 +751,35 @@ class MySQLDatabaseLayer(sql.BaseSQLLayer):
 
     def __init__(self, dbName, scripts=[], setup=None,
                  snapshotIdent=None, port=16543,
-                 mysql_bin_dir=None, defaults_file=None):
+                 mysql_bin_dir=None, defaults_file=None, spares=0,
+                 reset=sql.RESET_RESTORE, tabSnapshots=False,
+                 restoreWorkers=None, profile=None, profileSettings=None):
 
+        port = self._workerPort(port)
         self.port = port
         self.dbDir = os.path.join(self.base_path, 'data' + str(port))
         self.srvArgs = dict(port=self.port,
                             dbDir=self.dbDir,
                             defaults_file=defaults_file,
-                            mysql_bin_dir=mysql_bin_dir)
+                            mysql_bin_dir=mysql_bin_dir,
+                            tabSnapshots=tabSnapshots,
+                            restoreWorkers=restoreWorkers,
+                            profile=profile,
+                            profileSettings=profileSettings)
 
         super(MySQLDatabaseLayer, self).__init__(dbName, scripts, setup,
-                                                 snapshotIdent)
+                                                 snapshotIdent, spares, reset)
 
 
 
 
+    def _dump(self, path):
+        # the table files of a replaced tab snapshot are removed
+        old = os.path.isfile(path) and self.srv.tabDir(path)
+        super(MySQLDatabaseLayer, self)._dump(path)
+        if old and old != self.srv.tabDir(path) and os.path.isdir(old):
+            shutil.rmtree(old)
+
     @property
     def base_path(self):
         return BASE
@@ -246,3 +797,26 @@ class ExecuteSQL(object):
         conn.query(self.stmt)
         conn.commit()
         conn.close()
+
+
+class ExecuteSQLBatch(sql.BaseExecuteSQLBatch):
+
+    def _literal(self, conn, value):
+        from MySQLdb.converters import conversions
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return conn.escape(value, conversions)
+
+    def execute(self, conn, stmt, params):
+        if isinstance(params, dict):
+            stmt = stmt % dict([(k, self._literal(conn, v))
+                                for k, v in params.items()])
+        elif params is not None:
+            stmt = stmt % tuple([self._literal(conn, v) for v in params])
+        conn.query(stmt)
+        # results need to be consumed before the next query
+        conn.store_result()
+
+    def cursor(self, conn):
+        conn.autocommit(False)
+        return conn
@@ -17,22 +17,191 @@
 ##############################################################################
 
 import time
+import errno
 import os
-import stat
 import sys
 import hashlib
 import tempfile
-import shutil
+import glob
+import subprocess
+from cStringIO import StringIO
 import psycopg2
+import psycopg2.extensions
 from lovely.testlayers import util
 from lovely.testlayers import sql
-import re
 
 BASE = os.path.join(tempfile.gettempdir(), __name__)
 here = os.path.dirname(__file__)
 
-Q_PIDS="""select procpid from
-pg_stat_activity where datname='%s' and procpid <> pg_backend_pid();"""
+# the number of bytes sent at once when loading fixtures
+COPY_BUFFER_SIZE = 65536
+
+Q_PIDS="""select %(pid)s from
+pg_stat_activity where datname=%%s and %(pid)s <> pg_backend_pid();"""
+
+Q_TABLES = """select c.oid, quote_ident(n.nspname) || '.' || quote_ident(c.relname)
+from pg_class c join pg_namespace n on n.oid = c.relnamespace
+where c.relkind = %s and n.nspname not in ('pg_catalog', 'information_schema')
+and n.nspname not like 'pg_toast%%' and c.relname <> 'ltl_dirty';"""
+
+Q_REFERENCES = """select conrelid, confrelid from pg_constraint
+where contype = 'f';"""
+
+# records the names of tables modified by a statement
+DIRTY_FUNCTION = """create or replace function ltl_mark_dirty()
+returns trigger as $$
+declare
+    tbl text := quote_ident(TG_TABLE_SCHEMA) || '.' || quote_ident(TG_TABLE_NAME);
+begin
+    insert into ltl_dirty select tbl
+        where not exists (select 1 from ltl_dirty where name = tbl);
+    return null;
+end;
+$$ language plpgsql;"""
+
+
+def _confValue(value):
+    if value is True:
+        return 'on'
+    if value is False:
+        return 'off'
+    return str(value)
+
+
+def fastTestConf(pgVersion, settings=None, memory=None):
+    """generates a postgresql.conf for running tests
+
+    Durability is turned off and the memory settings are derived from
+    the memory of the host. The given settings override the generated
+    ones, string values are written as they are, so they need to be
+    quoted as in postgresql.conf.
+
+    >>> print fastTestConf((9, 6, 1), {'work_mem': "'8MB'", 'fsync': True},
+    ...                    memory=4096*1024**2)
+    fsync = on
+    full_page_writes = off
+    synchronous_commit = off
+    shared_buffers = 128MB
+    work_mem = '8MB'
+    max_connections = 100
+    autovacuum = off
+    datestyle = 'iso, dmy'
+    log_destination = 'stderr'
+    logging_collector = on
+    wal_level = minimal
+    max_wal_senders = 0
+    max_wal_size = 1GB
+    """
+    if memory is None:
+        memory = util.physical_memory() or 1024**3
+    mb = memory // 1024**2
+    conf = [('fsync', False),
+            ('full_page_writes', False)]
+    if pgVersion >= (8, 3):
+        conf.append(('synchronous_commit', False))
+    conf.extend([
+        ('shared_buffers', '%sMB' % min(max(mb // 32, 32), 512)),
+        ('work_mem', '%sMB' % min(max(mb // 512, 4), 64)),
+        ('max_connections', 100),
+        ('autovacuum', False),
+        ('datestyle', "'iso, dmy'"),
+        ('log_destination', "'stderr'"),
+        ('logging_collector', True),
+        ])
+    if pgVersion < (9, 2):
+        conf.append(('silent_mode', True))
+    if pgVersion >= (9, 0):
+        conf.extend([('wal_level', 'minimal'),
+                     ('max_wal_senders', 0)])
+    if pgVersion >= (9, 5):
+        conf.append(('max_wal_size', '1GB'))
+    else:
+        conf.append(('checkpoint_segments', 32))
+    settings = dict(settings or {})
+    lines = []
+    for name, value in conf:
+        value = settings.pop(name, value)
+        lines.append('%s = %s' % (name, _confValue(value)))
+    for name, value in sorted(settings.items()):
+        lines.append('%s = %s' % (name, _confValue(value)))
+    return '\n'.join(lines)
+
+
+def _copyValue(value):
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif isinstance(value, float):
+        # str keeps only 12 significant digits
+        value = repr(value)
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r')
+
+
+class CopyStream(object):
+    """A file like object which reads rows in COPY text format from an
+    iterable of row tuples
+
+    >>> stream = CopyStream(iter([(1, u'a\\tb'), (2, None)]))
+    >>> stream.read(4)
+    '1\\ta\\\\'
+    >>> stream.read()
+    'tb\\n2\\t\\\\N\\n'
+    >>> stream.read()
+    ''
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            try:
+                row = self.rows.next()
+            except StopIteration:
+                break
+            line = '\t'.join(map(_copyValue, row)) + '\n'
+            chunks.append(line)
+            length += len(line)
+        data = ''.join(chunks)
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    readline = read
+
+
+def queryReport(before, after, top=5):
+    """computes the number of calls and the time of the statements
+    executed between two query statistics, top lists the most expensive
+    statements
+
+    >>> before = {'select 1': (1, 2.0)}
+    >>> after = {'select 1': (3, 5.0), 'select 2': (1, 1.5)}
+    >>> sorted(queryReport(before, after, top=1).items())
+    [('calls', 3), ('time', 4.5), ('top', [(3.0, 2, 'select 1')])]
+    """
+    stmts = []
+    for query, (calls, ms) in after.items():
+        c, t = before.get(query, (0, 0.0))
+        if calls > c:
+            stmts.append((ms - t, calls - c, query))
+    stmts.sort(reverse=True)
+    return dict(calls=sum([s[1] for s in stmts]),
+                time=sum([s[0] for s in stmts]),
+                top=stmts[:top])
 
 
 class Server(sql.ServerBase):
@@ -41,8 +210,12 @@ class Server(sql.ServerBase):
     postgresqlConf = None
 
     def __init__(self, dbDir=None, host='127.0.0.1', port=5432,
-                 verbose=False, pgConfig='pg_config', postgresqlConf=None):
+                 verbose=False, pgConfig='pg_config', postgresqlConf=None,
+                 confSettings=None, instrument=False, explainThreshold=None):
         self.verbose = verbose
+        self.confSettings = confSettings
+        self.instrument = instrument
+        self.explainThreshold = explainThreshold
         self.port = port
         self.host = host
         self.dbDir = dbDir
@@ -56,20 +229,24 @@ class Server(sql.ServerBase):
         self.pgVersion = tuple(map(int,f.read().strip().split()[1].split('.')))
         f.close()
 
-        if postgresqlConf is None:
-            found = False
+        generated = (confSettings is not None or instrument
+                     or explainThreshold is not None)
+        if postgresqlConf is None and not generated:
             for i in range(len(self.pgVersion)):
                 v = '.'.join(map(str, self.pgVersion[:len(self.pgVersion)-i]))
                 name = 'postgresql%s.conf' % v
                 path = os.path.join(here, name)
                 if os.path.exists(path):
                     self.postgresqlConf = path
-                    found = True
                     break
-            if not found:
-                raise RuntimeError, "postgresql.conf not found for " \
-                      "version %r" % (self.pgVersion,)
-        else:
+            # without a shipped postgresql.conf the configuration is
+            # generated
+        elif postgresqlConf is not None:
+            if generated:
+                # the settings are only applied to a generated conf
+                raise ValueError, ("postgresqlConf can not be combined with "
+                                   "confSettings, instrument or "
+                                   "explainThreshold")
             if not os.path.exists(postgresqlConf):
                 raise ValueError, "postgresqlConf not found %r" % postgresqlConf
             self.postgresqlConf = postgresqlConf
@@ -79,6 +256,13 @@ class Server(sql.ServerBase):
         f = os.popen('%s --sharedir' % self.pgConfig)
         self.shareDir = f.read().strip()
         f.close()
+        f = os.popen('%s --pkglibdir' % self.pgConfig)
+        self.pkgLibDir = f.read().strip()
+        f.close()
+        for name in self.preloadLibraries:
+            if not self.hasContrib(name):
+                raise ValueError, "contrib module %s not installed for %r" % (
+                    name, self.pgConfig)
         self.psql = '%s -q -h %s -p %s' % (self.cmd('psql'),
                                         self.host,
                                         self.port)
@@ -86,42 +270,208 @@ class Server(sql.ServerBase):
     def cmd(self, name):
         return os.path.join(self.binDir, name)
 
+    @property
+    def serverVersion(self):
+        return self.pgVersion
+
+    @property
+    def startConfig(self):
+        return (self.pgConfig, self.postgresqlConf,
+                sorted((self.confSettings or {}).items()),
+                self.instrument, self.explainThreshold)
+
+    supportsRename = True
+    resetStrategies = (sql.RESET_RESTORE, sql.RESET_TRUNCATE)
+    adminErrors = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+    def _connectAdmin(self):
+        conn = psycopg2.connect(self._connectionString('postgres'))
+        conn.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+
+    def _executeAdmin(self, conn, stmt, args):
+        cur = conn.cursor()
+        try:
+            cur.execute(stmt, args)
+            if cur.description is None:
+                return []
+            return cur.fetchall()
+        finally:
+            cur.close()
+
+    def _connectionLost(self, conn):
+        return bool(conn.closed)
+
     def createDB(self, dbName):
-        cmd = '%s -p %s -h %s %s' % (self.cmd('createdb'),
-                                     self.port, self.host, dbName)
-        util.system(cmd)
+        self.execute('CREATE DATABASE "%s"' % dbName)
 
     def disconnectAll(self, dbName):
         """disconnects all from this db"""
+        if self.pgVersion >= (9, 2):
+            q = Q_PIDS % dict(pid='pid')
+        else:
+            q = Q_PIDS % dict(pid='procpid')
+        pids = self.execute(q, (dbName,))
+        for pid, in pids:
+            if self.pgVersion >= (8, 4):
+                self.execute('select pg_terminate_backend(%s)', (pid,))
+            else:
+                self.ctl(' kill TERM %s' % pid)
+        # backends terminate asynchronously
+        for i in range(500):
+            if not pids or not self.execute(q, (dbName,)):
+                break
+            time.sleep(0.01)
+
+    def dbExists(self, dbName):
+        return bool(self.execute(
+            'select 1 from pg_database where datname=%s', (dbName,)))
+
+    def dropDB(self, dbName):
+        if not self.dbExists(dbName):
+            return
+        self.disconnectAll(dbName)
+        self.execute('DROP DATABASE "%s"' % dbName)
 
-        cs = "dbname='%s' host='%s' port='%i'" % (dbName, self.host, self.port)
-        conn = psycopg2.connect(cs)
+    def renameDB(self, dbName, newName):
+        self.disconnectAll(dbName)
+        self.execute('ALTER DATABASE "%s" RENAME TO "%s"' % (dbName, newName))
+
+    def captureTables(self, dbName, strategy=sql.RESET_TRUNCATE):
+        """captures the rows of all tables in binary COPY format and
+        installs statement triggers which record modified tables"""
+        if strategy != sql.RESET_TRUNCATE:
+            raise NotImplementedError(
+                "%s does not support the %r reset strategy" % (
+                    self.__class__.__name__, strategy))
+        conn = self.newConnection(dbName)
         cur = conn.cursor()
-        cur.execute(Q_PIDS)
-        pids = cur.fetchall()
-        for pid, in pids:
-            self.ctl(' kill TERM %s' % pid)
+        cur.execute(Q_TABLES, ('r',))
+        tables = dict(cur.fetchall())
+        cur.execute('drop table if exists ltl_dirty')
+        cur.execute('create table ltl_dirty (name text)')
+        if self.pgVersion < (9, 0):
+            # plpgsql is only installed by default since 9.0
+            cur.execute("select 1 from pg_language where lanname='plpgsql'")
+            if cur.fetchone() is None:
+                cur.execute('create language plpgsql')
+        cur.execute(DIRTY_FUNCTION)
+        events = 'insert or update or delete'
+        if self.pgVersion >= (8, 4):
+            events += ' or truncate'
+        rows = {}
+        for name in tables.values():
+            cur.execute('drop trigger if exists ltl_dirty on %s' % name)
+            cur.execute('create trigger ltl_dirty after %s on %s '
+                        'for each statement execute procedure '
+                        'ltl_mark_dirty()' % (events, name))
+            f = StringIO()
+            cur.copy_expert('copy %s to stdout with binary' % name, f)
+            rows[name] = f.getvalue()
+        # truncating a table requires to truncate all tables referencing it
+        referencing = {}
+        cur.execute(Q_REFERENCES)
+        for table, referenced in cur.fetchall():
+            referencing.setdefault(tables[referenced], set()).add(
+                tables[table])
+        sequences = []
+        cur.execute(Q_TABLES, ('S',))
+        for oid, name in cur.fetchall():
+            cur.execute('select last_value, is_called from %s' % name)
+            sequences.append((name,) + cur.fetchone())
+        conn.commit()
         cur.close()
         conn.close()
+        return dict(rows=rows, referencing=referencing, sequences=sequences)
 
-    def dropDB(self, dbName):
-        if not dbName in self.listDatabases():
-            return
+    def reloadTables(self, dbName, data):
+        """truncates the modified tables and reloads their captured rows,
+        all sequences are reset"""
         self.disconnectAll(dbName)
-        cmd = '%s -p %s -h %s %s' % (self.cmd('dropdb'),
-                                     self.port, self.host, dbName)
-        util.system(cmd)
+        conn = self.newConnection(dbName)
+        cur = conn.cursor()
+        cur.execute('select name from ltl_dirty')
+        pending = [name for name, in cur.fetchall()]
+        reload = set()
+        while pending:
+            name = pending.pop()
+            if name in reload or name not in data['rows']:
+                continue
+            reload.add(name)
+            pending.extend(data['referencing'].get(name, ()))
+        if reload:
+            # disables the foreign key and ltl_dirty triggers
+            cur.execute('set session_replication_role = replica')
+            cur.execute('truncate %s' % ', '.join(sorted(reload)))
+            for name in reload:
+                cur.copy_expert('copy %s from stdin with binary' % name,
+                                StringIO(data['rows'][name]))
+            cur.execute('set session_replication_role = default')
+            cur.execute('delete from ltl_dirty')
+        if data['sequences']:
+            cur.execute('select %s' % ', '.join(
+                ['setval(%s, %s, %s)'] * len(data['sequences'])),
+                        sum(data['sequences'], ()))
+        conn.commit()
+        cur.close()
+        conn.close()
 
-    def runScripts(self, dbName, scripts):
-        """runs sql scripts from given paths"""
-        for script in scripts:
-            script = self.resolveScriptPath(script)
-            if self.verbose:
-                output = ''
-            else:
-                output = '>/dev/null 2>&1'
-            util.system('%s -q -f %s %s %s' % (
-                                    self.psql, script, dbName, output))
+    def setUnlogged(self, dbName):
+        """turns all tables of the database into unlogged tables"""
+        if self.pgVersion < (9, 5):
+            raise RuntimeError, "Unlogged tables require postgresql 9.5"
+        conn = self.newConnection(dbName)
+        conn.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cur = conn.cursor()
+        cur.execute(Q_TABLES, ('r',))
+        pending = [name for oid, name in cur.fetchall()]
+        # tables referencing a logged table can not be altered, so failed
+        # tables are retried after the others
+        while pending:
+            failed = []
+            for name in pending:
+                try:
+                    cur.execute('alter table %s set unlogged' % name)
+                except psycopg2.Error:
+                    failed.append(name)
+            if len(failed) == len(pending):
+                raise RuntimeError, "Unable to set tables unlogged %r" % (
+                    failed,)
+            pending = failed
+        cur.close()
+        conn.close()
+
+    def runScripts(self, dbName, scripts, transaction=False):
+        """runs sql scripts from given paths in a single psql session"""
+        paths = [self.resolveScriptPath(script) for script in scripts]
+        mark = "select '%s ' || extract(epoch from clock_timestamp());" % (
+            sql.SCRIPT_MARK)
+        lines = [mark]
+        for path in paths:
+            lines.append("\\i '%s'" % path)
+            lines.append(mark)
+        wrapper = tempfile.NamedTemporaryFile(suffix='.sql')
+        wrapper.write('\n'.join(lines) + '\n')
+        wrapper.flush()
+        opts = '-A -t'
+        if transaction:
+            opts += ' -1 -v ON_ERROR_STOP=1'
+        cmd = '%s %s -f %s %s' % (self.psql, opts, wrapper.name, dbName)
+        if self.verbose:
+            stderr = None
+        else:
+            stderr = subprocess.PIPE
+        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                             stderr=stderr)
+        output = p.communicate()[0]
+        wrapper.close()
+        if p.returncode:
+            raise SystemError("Failed", cmd)
+        self.scriptTimings = sql.scriptTimings(paths, output)
+        if self.verbose:
+            self.printScriptTimings()
 
     def resolveScriptPath(self, path):
         parts = path.split(':')
@@ -136,24 +486,101 @@ class Server(sql.ServerBase):
         return os.path.join(base, path)
 
     def initDB(self):
-#         if not os.path.exists(self.dbDir):
-#             os.makedirs(self.dbDir)
-        cmd = '%s -A trust -D %s >/dev/null' % (self.cmd('initdb'),
-                                                self.dbDir)
+        args = '-A trust'
         t = time.time()
-        util.system(cmd)
+        if self.clusterCache:
+            key = hashlib.sha1(repr(
+                (self.pgConfig, self.pgVersion, args))).hexdigest()
+            util.cached_tree('postgresql', key, self.dbDir,
+                             lambda path: self._initdb(path, args))
+        else:
+            self._initdb(self.dbDir, args)
         print >> sys.stderr, "INITDB: %r in %s secs" % (self.dbDir,
                                                         time.time()-t)
 
+    def _initdb(self, path, args):
+        cmd = '%s %s -D %s >/dev/null' % (self.cmd('initdb'), args, path)
+        util.system(cmd)
+
+    @property
+    def preloadLibraries(self):
+        libraries = []
+        if self.instrument:
+            libraries.append('pg_stat_statements')
+        if self.explainThreshold is not None:
+            libraries.append('auto_explain')
+        return libraries
+
+    def hasContrib(self, name):
+        """contrib modules like pg_stat_statements are available since 8.4
+        if contrib got installed along with the server"""
+        if self.pgVersion < (8, 4):
+            return False
+        return bool(glob.glob(os.path.join(self.pkgLibDir, name + '.*')))
+
+    def generateConf(self):
+        settings = {}
+        libraries = self.preloadLibraries
+        if self.explainThreshold is not None:
+            settings['auto_explain.log_min_duration'] = "'%sms'" % (
+                self.explainThreshold)
+            if self.pgVersion < (9, 2):
+                settings['custom_variable_classes'] = "'auto_explain'"
+        if libraries:
+            settings['shared_preload_libraries'] = "'%s'" % ','.join(
+                libraries)
+        settings.update(self.confSettings or {})
+        return fastTestConf(self.pgVersion, settings)
+
+    def queryStats(self, dbName):
+        """returns the calls and the total time in milliseconds of the
+        statements executed in a database by query, this requires the
+        server to be started with ``instrument=True``"""
+        if self.pgVersion >= (9, 1):
+            self.execute('create extension if not exists pg_stat_statements')
+        elif not self.execute("select 1 from pg_class "
+                              "where relname = 'pg_stat_statements'"):
+            # before extensions the contrib script creates the view
+            f = open(os.path.join(self.shareDir, 'contrib',
+                                  'pg_stat_statements.sql'))
+            self.execute(f.read())
+            f.close()
+        if self.pgVersion >= (13,):
+            total = 'total_exec_time'
+        else:
+            total = 'total_time'
+        # the total time is measured in seconds before 9.2
+        scale = self.pgVersion < (9, 2) and 1000.0 or 1.0
+        rows = self.execute(
+            'select s.query, s.calls, s.%s from pg_stat_statements s '
+            'join pg_database d on d.oid = s.dbid where d.datname = %%s' % (
+            total), (dbName,))
+        stats = {}
+        for query, calls, ms in rows:
+            c, t = stats.get(query, (0, 0.0))
+            stats[query] = (c + calls, t + ms * scale)
+        return stats
 
     def _copyConf(self):
+        # the contents are compared instead of the modification time,
+        # because db directories copied from the cluster cache keep the
+        # modification time of the cached conf
         to = os.path.join(self.dbDir, 'postgresql.conf')
-        if os.path.exists(to) and (
-            os.stat(to)[stat.ST_MTIME] <= os.stat(
-            self.postgresqlConf)[stat.ST_MTIME]):
-            return False
-        # copy conf
-        shutil.copyfile(self.postgresqlConf, to)
+        if self.postgresqlConf is None:
+            conf = self.generateConf()
+        else:
+            f = open(self.postgresqlConf)
+            conf = f.read()
+            f.close()
+        if os.path.exists(to):
+            f = open(to)
+            current = f.read()
+            f.close()
+            if current == conf:
+                return False
+        f = open(to, 'w')
+        f.write(conf)
+        f.close()
         return True
 
     def ctl(self, arg):
@@ -172,36 +599,36 @@ class Server(sql.ServerBase):
         self.ctl('-o "-p %s" -s -w start' % self.port)
 
     def stop(self):
+        self.closeAdminConnection()
         self.ctl('stop -s -w -m fast > /dev/null')
 
     def isRunning(self):
-        o, i , e = os.popen3('%s -D %s -w status' % (self.cmd('pg_ctl'),
-                                                     self.dbDir))
-        res = i.read()
-        o.close()
-        i.close()
-        e.close()
-        return 'is running' in res
+        if self.dbDir is None:
+            return False
+        try:
+            f = open(os.path.join(self.dbDir, 'postmaster.pid'))
+            try:
+                pid = int(f.readline())
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return False
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno == errno.EPERM
+        return True
 
     def isListening(self):
-        i, o, e = os.popen3('%s -l' % self.psql)
-        return not e.read()
+        try:
+            self.execute('select 1')
+        except (RuntimeError,) + self.adminErrors:
+            return False
+        return True
 
     def listDatabases(self):
-        f = os.popen('%s -l' % self.psql)
-        res = f.read()
-
-        res = res.split('\n')[3:]
-        dbs = []
-        pat = re.compile(r'^(\w+)\s.*')
-        for l in res:
-            if not l:
-                break
-            m = pat.match(l.strip())
-            if m:
-                dbs.append(m.group(1))
-        f.close()
-        return dbs
+        return [name for name, in self.execute(
+            'select datname from pg_database')]
 
     def dump(self, dbName, path):
         assert self.isRunning()
@@ -232,9 +659,12 @@ class Server(sql.ServerBase):
     def getURI(self, dbName):
         return 'postgres://localhost:%s/%s' % (self.port, dbName)
 
+    def _connectionString(self, dbName):
+        return "dbname='%s' host='%s' port='%i'" % (dbName, self.host,
+                                                   self.port)
+
     def newConnection(self, dbName):
-        cs = "dbname='%s' host='%s' port='%i'" % (dbName, self.host, self.port)
-        return psycopg2.connect(cs)
+        return psycopg2.connect(self._connectionString(dbName))
 
 
 class PGDBScript(sql.BaseSQLScript):
@@ -254,21 +684,115 @@ class PGDatabaseLayer(sql.BaseSQLLayer):
 
     def __init__(self, dbName, scripts=[], setup=None,
                  snapshotIdent=None, verbose=False,
-                 port=15432, pgConfig='pg_config', postgresqlConf=None):
-        self.dbDir = os.path.join(self.base_path, 'data')
+                 port=15432, pgConfig='pg_config', postgresqlConf=None,
+                 spares=0, reset=sql.RESET_RESTORE, confSettings=None,
+                 unlogged=False, instrument=False, explainThreshold=None,
+                 reportTop=5):
+        port = self._workerPort(port)
+        self.dbDir = os.path.join(self.base_path, 'data' + str(port))
         self.verbose = verbose
         self.port = port
+        self.unlogged = unlogged
+        self.instrument = instrument
+        self.reportTop = reportTop
+        self.queryReports = []
         self.srvArgs = dict(verbose=verbose,
                             port=self.port,
                             dbDir=self.dbDir,
                             pgConfig=pgConfig,
-                            postgresqlConf=postgresqlConf)
-        super(PGDatabaseLayer, self).__init__(dbName, scripts, setup, snapshotIdent)
+                            postgresqlConf=postgresqlConf,
+                            confSettings=confSettings,
+                            instrument=instrument,
+                            explainThreshold=explainThreshold)
+        super(PGDatabaseLayer, self).__init__(dbName, scripts, setup,
+                                              snapshotIdent, spares, reset)
+
+    def testSetUp(self):
+        super(PGDatabaseLayer, self).testSetUp()
+        if self.instrument:
+            self._queryStats = self.srv.queryStats(self.dbName)
+
+    def testTearDown(self):
+        if self.instrument:
+            report = queryReport(self._queryStats,
+                                 self.srv.queryStats(self.dbName),
+                                 self.reportTop)
+            self.queryReports.append(report)
+            print >> sys.stderr, "QUERIES: %s calls in %.3f ms" % (
+                report['calls'], report['time'])
+            for ms, calls, query in report['top']:
+                print >> sys.stderr, "  %.3f ms %s calls: %s" % (
+                    ms, calls, ' '.join(query.split()))
+        super(PGDatabaseLayer, self).testTearDown()
+
+    def _dump(self, path):
+        if self.unlogged:
+            self.srv.setUnlogged(self.dbName)
+        super(PGDatabaseLayer, self)._dump(path)
 
     @property
     def base_path(self):
         return BASE
 
+    def loadFixture(self, table, source, columns=None, header=False,
+                    size=COPY_BUFFER_SIZE):
+        """streams rows into a table with COPY FROM STDIN
+
+        The source is either an iterable of row tuples or the path of a
+        csv file. Only ``size`` bytes are buffered at a time.
+        """
+        if columns:
+            table = '%s (%s)' % (table, ', '.join(columns))
+        conn = self.newConnection()
+        cur = conn.cursor()
+        if isinstance(source, basestring):
+            options = 'csv'
+            if header:
+                options += ' header'
+            f = open(source, 'rb')
+            try:
+                cur.copy_expert('copy %s from stdin with %s' % (
+                    table, options), f, size)
+            finally:
+                f.close()
+        else:
+            cur.copy_expert('copy %s from stdin' % table,
+                            CopyStream(source), size)
+        conn.commit()
+        cur.close()
+        conn.close()
+
+
+class LoadFixture(object):
+    """A setup which loads rows into a table, see
+    PGDatabaseLayer.loadFixture
+
+    The name is built from the contents of the csv file or the rows, if
+    the rows are not a list or tuple an ident needs to be given.
+    """
+
+    def __init__(self, table, source, columns=None, header=False,
+                 ident=None):
+        self.table = table
+        self.source = source
+        self.columns = columns
+        self.header = header
+        if ident is None:
+            if isinstance(source, basestring):
+                f = open(source, 'rb')
+                ident = hashlib.sha1(f.read()).hexdigest()
+                f.close()
+            elif isinstance(source, (list, tuple)):
+                ident = hashlib.sha1(repr(source)).hexdigest()
+            else:
+                raise ValueError, "An ident is required for %r" % (source,)
+        self.__name__ = self.__class__.__name__ + hashlib.sha1(repr(
+            (table, columns, header, ident))).hexdigest()
+
+    def __call__(self, layer):
+        layer.loadFixture(self.table, self.source, self.columns, self.header)
+
+
 class ExecuteSQL(object):
 
     def __init__(self, stmt):
@@ -283,3 +807,15 @@ class ExecuteSQL(object):
         conn.commit()
         cur.close()
         conn.close()
+
+
+class ExecuteSQLBatch(sql.BaseExecuteSQLBatch):
+
+    def cursor(self, conn):
+        return conn.cursor()
+
+    def execute(self, cur, stmt, params):
+        cur.execute(stmt, params)
+
+    def executeMany(self, cur, stmt, params):
+        cur.executemany(stmt, params)
@@ -20,6 +20,8 @@ import os
 import sys
 import hashlib
 import tempfile
+import threading
+from collections import deque
 from optparse import OptionParser
 from lovely.testlayers import util
 
@@ -28,20 +30,242 @@ try:
 except ImportError:
     transaction = None
 
+SCRIPT_MARK = 'ltl-mark'
+
+# strategies to reset the database between tests:
+# restore the snapshot of the database
+RESET_RESTORE = 'restore'
+# truncate modified tables and reload their captured rows
+RESET_TRUNCATE = 'truncate'
+# rebuild modified tables from a shadow copy kept inside the server
+RESET_SHADOW = 'shadow'
+RESET_STRATEGIES = (RESET_RESTORE, RESET_TRUNCATE, RESET_SHADOW)
+
+# the number of layers using a running server and its start
+# configuration, keyed by (server implementation, db directory, port)
+SERVERS = {}
+
+
+def scriptTimings(scripts, output):
+    """computes the runtime of scripts from the timestamps emitted
+    before and after each script
+
+    >>> scriptTimings(['a.sql', 'b.sql'],
+    ...               'ltl-mark 10.0\\nltl-mark 10.5\\nx\\nltl-mark 12.0\\n')
+    [('a.sql', 0.5), ('b.sql', 1.5)]
+    """
+    stamps = []
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[0] == SCRIPT_MARK:
+            stamps.append(float(parts[1]))
+    return [(script, end - start) for script, start, end in
+            zip(scripts, stamps, stamps[1:])]
+
+
+def batchStatements(statements):
+    """normalizes statements of a batch setup to (statement, parameters)
+    tuples
+
+    >>> class ExecuteSQL(object):
+    ...     stmt = 'delete from a'
+    >>> from pprint import pprint
+    >>> pprint(batchStatements(['select 1', ('select %s', (1,)), ExecuteSQL(),
+    ...                         ('insert into a values (%s)', [(1,), (2,)])]))
+    [('select 1', None),
+     ('select %s', (1,)),
+     ('delete from a', None),
+     ('insert into a values (%s)', [(1,), (2,)])]
+    """
+    result = []
+    for stmt in statements:
+        if isinstance(stmt, tuple):
+            result.append(stmt)
+        elif isinstance(stmt, basestring):
+            result.append((stmt, None))
+        else:
+            result.append((stmt.stmt, None))
+    return result
+
+
+class BaseExecuteSQLBatch(object):
+    """Executes statements in one transaction on a single connection
+
+    The statements are sql strings, ``ExecuteSQL`` setups or tuples of a
+    statement and its parameters. If the parameters are a list the
+    statement is executed for each item of the list. If a statement fails
+    the transaction is rolled back.
+    """
+
+    def __init__(self, statements):
+        self.statements = batchStatements(statements)
+        self.__name__ = self.__class__.__name__ + hashlib.sha1(repr(
+            self.statements)).hexdigest()
+
+    def cursor(self, conn):
+        """returns the object statements are executed with"""
+        raise NotImplementedError
+
+    def execute(self, cur, stmt, params):
+        raise NotImplementedError
+
+    def executeMany(self, cur, stmt, params):
+        for p in params:
+            self.execute(cur, stmt, p)
+
+    def __call__(self, layer):
+        conn = layer.newConnection()
+        try:
+            cur = self.cursor(conn)
+            try:
+                for stmt, params in self.statements:
+                    if isinstance(params, list):
+                        self.executeMany(cur, stmt, params)
+                    else:
+                        self.execute(cur, stmt, params)
+                conn.commit()
+            except:
+                conn.rollback()
+                raise
+        finally:
+            conn.close()
+
+
+# the distance between the ports of two test runner subprocesses
+WORKER_PORT_STRIDE = 100
+
+
+def workerNumber():
+    """returns the number of the test runner subprocess or 0
+
+    zope.testrunner passes the number of a subprocess with the
+    ``--resume-layer`` option, it can be overridden with the
+    LOVELY_TESTLAYERS_WORKER environment variable.
+    """
+    worker = os.environ.get('LOVELY_TESTLAYERS_WORKER')
+    if worker:
+        return int(worker)
+    if '--resume-layer' in sys.argv:
+        i = sys.argv.index('--resume-layer')
+        try:
+            return int(sys.argv[i + 2])
+        except (IndexError, ValueError):
+            pass
+    return 0
+
 
 class ServerBase(object):
 
     """Base class for abstracting sql servers"""
 
+    scriptTimings = ()
+    # copy new db directories from a cached pristine cluster
+    clusterCache = True
+    # spare databases are renamed into place, which needs a complete
+    # rename of a database including views, triggers and routines
+    supportsRename = False
+    # the reset strategies supported by the server
+    resetStrategies = (RESET_RESTORE,)
+
     def resolveScriptPath(self, path):
         return os.path.abspath(path)
 
+    @property
+    def startConfig(self):
+        """the settings the server is started with, layers only share a
+        running server with the same settings"""
+        return None
+
+    @property
+    def serverVersion(self):
+        raise NotImplementedError
+
+    def printScriptTimings(self):
+        for script, secs in self.scriptTimings:
+            print >> sys.stderr, "SCRIPT: %r in %.3f secs" % (script, secs)
+
     def dbExists(self, dbName):
         return dbName in self.listDatabases()
 
     def isListening(self):
         return self.isRunning()
 
+    # the persistent admin connection used for administrative statements,
+    # implementations define how to connect and execute
+    adminErrors = ()
+    _admin = None
+
+    @property
+    def _adminLock(self):
+        return self.__dict__.setdefault('_lock', threading.RLock())
+
+    def _connectAdmin(self):
+        raise NotImplementedError
+
+    def _executeAdmin(self, conn, stmt, args):
+        raise NotImplementedError
+
+    def _connectionLost(self, conn):
+        raise NotImplementedError
+
+    def adminConnection(self):
+        """returns the admin connection or None if the server is not
+        reachable"""
+        with self._adminLock:
+            if self._admin is None:
+                try:
+                    self._admin = self._connectAdmin()
+                except self.adminErrors:
+                    return None
+            return self._admin
+
+    def closeAdminConnection(self):
+        with self._adminLock:
+            if self._admin is not None:
+                try:
+                    self._admin.close()
+                except self.adminErrors:
+                    pass
+                self._admin = None
+
+    def execute(self, stmt, args=None):
+        """executes a statement on the admin connection and returns the
+        resulting rows, a lost connection is reestablished once"""
+        with self._adminLock:
+            for retry in (True, False):
+                conn = self.adminConnection()
+                if conn is None:
+                    raise RuntimeError, "No sql server listening on %s:%s" % (
+                        self.host, self.port)
+                try:
+                    return self._executeAdmin(conn, stmt, args)
+                except self.adminErrors:
+                    if not self._connectionLost(conn):
+                        raise
+                    self.closeAdminConnection()
+                    if not retry:
+                        raise
+
+    def renameDB(self, dbName, newName):
+        raise NotImplementedError("%s does not support renaming databases" %
+                                  self.__class__.__name__)
+
+    def captureTables(self, dbName, strategy=RESET_TRUNCATE):
+        """captures the rows of all tables for the given reset strategy,
+        returns the data needed by reloadTables"""
+        raise NotImplementedError("%s does not support capturing tables" %
+                                  self.__class__.__name__)
+
+    def reloadTables(self, dbName, data):
+        """reloads the captured rows of all modified tables, returns
+        False if the tables can not be reset in place and the snapshot
+        needs to be restored instead"""
+        raise NotImplementedError("%s does not support reloading tables" %
+                                  self.__class__.__name__)
+
+    def releaseTables(self, data):
+        pass
+
 class ServerGetterMixin(object):
 
     server_impl = None
@@ -139,9 +363,33 @@ class BaseSQLLayer(ServerGetterMixin):
     setup = None
     snapshotIdent = None
     firstTest = True
-
-    def __init__(self, dbName, scripts=[], setup=None, snapshotIdent=None):
+    spares = 0
+    # run all scripts as one transaction
+    scriptsTransaction = False
+    reset = RESET_RESTORE
+    _tableData = None
+    _serverAcquired = False
+    # use a port and db directory per test runner subprocess, the ports
+    # of the workers are WORKER_PORT_STRIDE apart so that they do not
+    # collide with the ports of other layers, which are usually close to
+    # each other
+    workerPorts = True
+
+    def __init__(self, dbName, scripts=[], setup=None, snapshotIdent=None,
+                 spares=0, reset=RESET_RESTORE):
+        if reset not in RESET_STRATEGIES:
+            raise ValueError, "Unknown reset strategy %r" % reset
+        if reset not in self.server_impl.resetStrategies:
+            raise ValueError, "%s does not support the %r reset strategy" % (
+                self.server_impl.__module__, reset)
+        if spares and not self.server_impl.supportsRename:
+            raise ValueError, "%s does not support spare databases" % (
+                self.server_impl.__module__)
         self.dbName = dbName
+        self.spares = spares
+        self.reset = reset
+        self._spares = deque()
+        self._spareCounter = 0
         self.scripts_hash = self._gen_scripts_hash(scripts)
         self.scripts = scripts
         if setup is not None:
@@ -158,24 +406,74 @@ class BaseSQLLayer(ServerGetterMixin):
             self.scripts_hash, ident))
 
     def _gen_scripts_hash(self, scripts):
-        ident = []
+        # the contents are used instead of the modification time, so
+        # snapshots are reused for fresh checkouts of the same scripts
+        digest = hashlib.sha1(repr(self.srv.serverVersion))
         for script in scripts:
             path = self.srv.resolveScriptPath(script)
-            statinfo = os.stat(path)
-            ident.append((path, statinfo.st_mtime))
-        digest = hashlib.sha1(str(ident)).hexdigest()
-        return digest
+            f = open(path, 'rb')
+            digest.update(hashlib.sha1(f.read()).hexdigest())
+            f.close()
+        return digest.hexdigest()
+
+    def _workerPort(self, port):
+        """parallel test runner processes use their own server, so the
+        port gets offset by a multiple of the worker number"""
+        if self.workerPorts:
+            return port + WORKER_PORT_STRIDE * workerNumber()
+        return port
+
+    def _dump(self, path):
+        # snapshots are shared with other processes, so they are created
+        # under a temporary name
+        tmp = '%s.%s.tmp' % (path, os.getpid())
+        self.srv.dump(self.dbName, tmp)
+        os.rename(tmp, path)
 
     def snapshotInfo(self, ident):
         sp = self._snapPath(ident)
         return os.path.isfile(sp), sp
 
-    def setUp(self):
-        if util.isUp('localhost', self.port):
+    @property
+    def _serverKey(self):
+        return (self.server_impl, os.path.abspath(self.dbDir), self.port)
+
+    def _acquireServer(self):
+        """starts the server unless it is already running for another
+        layer"""
+        if self._serverAcquired:
             raise RuntimeError, "Port already listening: %r" % self.port
-        if not os.path.exists(self.dbDir):
-            self.srv.initDB()
-        self.srv.start()
+        key = self._serverKey
+        config = self.srv.startConfig
+        users, running = SERVERS.get(key, (0, config))
+        if not users:
+            if util.isUp('localhost', self.port):
+                raise RuntimeError, "Port already listening: %r" % self.port
+            if not os.path.exists(self.dbDir):
+                self.srv.initDB()
+            self.srv.start()
+        elif running != config:
+            raise RuntimeError, (
+                "Server on port %r runs with another configuration" % (
+                self.port))
+        SERVERS[key] = (users + 1, config)
+        self._serverAcquired = True
+
+    def _releaseServer(self):
+        """stops the server if this layer is the last one using it"""
+        if not self._serverAcquired:
+            return
+        self._serverAcquired = False
+        key = self._serverKey
+        users, config = SERVERS.pop(key)
+        users -= 1
+        if users:
+            SERVERS[key] = (users, config)
+        else:
+            self.srv.stop()
+
+    def setUp(self):
+        self._acquireServer()
         exists, sp = self.snapshotInfo('__scripts__')
         if exists:
             if not self.srv.dbExists(self.dbName):
@@ -187,28 +485,82 @@ class BaseSQLLayer(ServerGetterMixin):
             self.srv.createDB(self.dbName)
             if self.scripts:
                 try:
-                    self.srv.runScripts(self.dbName, self.scripts)
+                    self.srv.runScripts(self.dbName, self.scripts,
+                                        self.scriptsTransaction)
                 except:
-                    self.srv.stop()
+                    self._releaseServer()
                     raise
-            self.srv.dump(self.dbName, sp)
+            self._dump(sp)
         # create the snapshot for app
         dirty = False
         if self.setup is not None:
             exists, sps = self.snapshotInfo(self.snapshotIdent)
             if not exists:
                 self.setup(self)
-                self.srv.dump(self.dbName, sps)
+                self._dump(sps)
             else:
                 self.srv.restore(self.dbName, sps)
+        if self.reset != RESET_RESTORE:
+            self._tableData = self.srv.captureTables(self.dbName, self.reset)
+        else:
+            for i in range(self.spares):
+                self._prepareSpare()
+
+    def _prepareSpare(self):
+        """restores the current snapshot into a spare database in the
+        background"""
+        exists, sps = self.snapshotInfo(self.snapshotIdent or '__scripts__')
+        assert exists
+        self._spareCounter += 1
+        name = '%s__spare%s' % (self.dbName, self._spareCounter)
+        result = {}
+        def prepare():
+            try:
+                self.srv.restore(name, sps)
+            except Exception, e:
+                result['error'] = e
+        thread = threading.Thread(target=prepare, name=name)
+        thread.setDaemon(True)
+        thread.start()
+        self._spares.append((name, thread, result))
+
+    def _swapSpare(self):
+        """replaces the database with the oldest spare, returns False if
+        no usable spare is available"""
+        if not self._spares:
+            return False
+        name, thread, result = self._spares.popleft()
+        thread.join()
+        try:
+            if 'error' in result:
+                print >> sys.stderr, "SPARE %r failed: %s" % (
+                    name, result['error'])
+                self.srv.dropDB(name)
+                return False
+            self.srv.dropDB(self.dbName)
+            self.srv.renameDB(name, self.dbName)
+        finally:
+            self._prepareSpare()
+        return True
+
+    def _dropSpares(self):
+        while self._spares:
+            name, thread, result = self._spares.popleft()
+            thread.join()
+            self.srv.dropDB(name)
 
     def testSetUp(self):
         ident = self.snapshotIdent or '__scripts__'
-        if not self.firstTest:
+        if not self.firstTest and self.reset != RESET_RESTORE:
+            if self.srv.reloadTables(self.dbName, self._tableData) is False:
+                exists, sps = self.snapshotInfo(ident)
+                self.srv.restore(self.dbName, sps)
+        elif not self.firstTest:
             # if we run the first time we ar clean
             exists, sps = self.snapshotInfo(ident)
             assert exists
-            self.srv.restore(self.dbName, sps)
+            if not self._swapSpare():
+                self.srv.restore(self.dbName, sps)
         self.firstTest = False
 
     def testTearDown(self):
@@ -222,7 +574,11 @@ class BaseSQLLayer(ServerGetterMixin):
 
     def tearDown(self):
         self.firstTest = True
-        self.srv.stop()
+        self._dropSpares()
+        if self._tableData is not None:
+            self.srv.releaseTables(self._tableData)
+            self._tableData = None
+        self._releaseServer()
 
     def newConnection(self):
         return self.srv.newConnection(self.dbName)
@@ -67,6 +67,19 @@ def create_suite(testfile, setUp=setUp,
     return s
 
 
+def has_pg_contrib(name):
+    """checks if a contrib module got installed with the postgres of this
+    project"""
+    pg_config = project_path('parts', 'postgres', 'bin', 'pg_config')
+    if not os.path.exists(pg_config):
+        return False
+    try:
+        from lovely.testlayers import pgsql
+    except ImportError:
+        return False
+    return pgsql.Server(pgConfig=pg_config).hasContrib(name)
+
+
 def test_suite():
     suites = (
         create_suite('layer.txt', setUp=cleanWorkDirs),
@@ -80,6 +93,8 @@ def test_suite():
         create_suite('mysql.txt', setUp=cleanWorkDirs, level=2),
         create_suite('nginx.txt')
         )
+    if has_pg_contrib('pg_stat_statements'):
+        suites += (create_suite('pgsql_instrument.txt'),)
     return unittest.TestSuite(suites)
 
 
@@ -95,6 +110,7 @@ def mongodb_suite():
         create_suite('mongodb_single.txt'),
         create_suite('mongodb_masterslave.txt'),
         create_suite('mongodb_replicaset.txt'),
+        create_suite('mongodb_sharding.txt'),
     )
     return unittest.TestSuite(suites)
 
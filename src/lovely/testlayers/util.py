@@ -1,7 +1,15 @@
 import os
+import sys
+import errno
 import types
+import hashlib
+import shutil
 import socket
 import logging
+import tempfile
+
+# machine wide cache for artifacts which are expensive to create
+CACHE = os.path.join(tempfile.gettempdir(), 'lovely.testlayers.cache')
 
 def isUp(host, port):
     """test if a host is up"""
@@ -13,6 +21,27 @@ def isUp(host, port):
     return False
 
 
+def physical_memory():
+    """returns the physical memory of the host in bytes or None if it is
+    unknown"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def file_hash(path):
+    """returns the SHA-256 hex digest of the contents of a file"""
+    digest = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(65536), ''):
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
 def dotted_name(obj):
     return u'.'.join([obj.__module__ ,obj.__name__])
 
@@ -33,6 +62,69 @@ def system(c):
         raise SystemError("Failed", c)
 
 
+def makedirs(path):
+    """creates a directory and its parents, a directory created by
+    another process in the meantime is fine"""
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def copytree(src, dst):
+    """copies a directory tree, on linux the files are reflinked if the
+    filesystem supports it"""
+    parent = os.path.dirname(os.path.abspath(dst))
+    if not os.path.isdir(parent):
+        makedirs(parent)
+    if sys.platform.startswith('linux'):
+        if not os.system('cp -a --reflink=auto "%s" "%s"' % (src, dst)):
+            return
+    shutil.copytree(src, dst, symlinks=True)
+
+
+def cache_tree(kind, key, create):
+    """returns the path of the cached directory tree identified by kind
+    and key
+
+    On a cache miss ``create`` gets called with a not existing path and
+    needs to create the tree there, the tree is moved into the cache
+    atomically.
+    """
+    cached = os.path.join(CACHE, kind, key)
+    if not os.path.isdir(cached):
+        parent = os.path.dirname(cached)
+        if not os.path.isdir(parent):
+            makedirs(parent)
+        tmp = tempfile.mkdtemp(prefix=key + '.', dir=parent)
+        try:
+            tree = os.path.join(tmp, 'tree')
+            create(tree)
+            try:
+                os.rename(tree, cached)
+            except OSError, e:
+                # created by another process in the meantime
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY) or \
+                   not os.path.isdir(cached):
+                    raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return cached
+
+
+def cached_tree(kind, key, dst, create):
+    """copies the cached directory tree identified by kind and key to dst
+
+    On a cache miss ``create`` gets called with a not existing path and
+    needs to create the tree there. An empty dst directory gets replaced.
+    """
+    cached = cache_tree(kind, key, create)
+    if os.path.isdir(dst) and not os.listdir(dst):
+        os.rmdir(dst)
+    copytree(cached, dst)
+
+
 class DuplicateSuppressingLogFilter(logging.Filter):
     """
     Suppress duplicate log messages.